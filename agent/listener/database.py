@@ -1,5 +1,7 @@
 import os
+import re
 import time
+import collections
 import sqlite3
 import sys
 import listener.server
@@ -9,8 +11,24 @@ from ncpa import listener_logger as logging
 # A module to wrap sqlite3 for use with a small database to store things
 # like checks across both passive and active sections
 
+# Cached filtered check counts, keyed by the filter values, so that paging through
+# a filtered check log only has to count the rows added since the last page view.
+# Only the most recently used search_counts_max searches are kept.
+search_counts = collections.OrderedDict()
+search_counts_max = 100
+
+
 class DB(object):
 
+    # Check log retention deletes in batches, the batch size is adjusted so each
+    # batch (which holds the database lock) takes around prune_batch_time seconds
+    prune_batch_size = 500
+    prune_batch_min = 50
+    prune_batch_max = 5000
+    prune_batch_time = 0.005
+    prune_pause = 0.05
+    vacuum_batch_pages = 200
+
     def __init__(self):
         if getattr(sys, 'frozen', False):
             self.dbfile = os.path.abspath(os.path.dirname(sys.executable) + '/var/ncpa.db')
@@ -31,35 +49,229 @@ class DB(object):
 
     def truncate(self, dbname):
         self.cursor.execute('DROP TABLE %s' % dbname)
+        if dbname == 'checks':
+            self.cursor.execute('DELETE FROM check_counts')
+            if self.has_search_index():
+                self.cursor.execute("INSERT INTO checks_fts (checks_fts) VALUES ('delete-all')")
+            search_counts.clear()
         self.cursor.execute('VACUUM')
         self.setup()
         return True
 
     # This is called on both passive and listener startup
-    def setup(self):
+    def setup(self, config=None):
         
+        # Switch the database to incremental auto vacuum so maintenance can give space
+        # back to the filesystem, existing databases need one full VACUUM for this
+        if config is not None:
+            try:
+                vacuum = config.getboolean('general', 'check_logging_vacuum')
+            except Exception as e:
+                vacuum = False
+            self.cursor.execute('PRAGMA auto_vacuum')
+            if vacuum and self.cursor.fetchone()[0] != 2:
+                self.cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                self.cursor.execute('VACUUM')
+
         # Create main check results database and migration database
         self.cursor.execute('CREATE TABLE IF NOT EXISTS checks (accessor, run_time_start, run_time_end, result, output, sender, type)')
         self.cursor.execute('CREATE TABLE IF NOT EXISTS migrations (id, version)')
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS maintenance (run_time_start, run_time_end, rows_pruned, batches, busy_time, max_batch_time, pages_vacuumed)')
+
+        # Index used to page through the check log by (run_time_start, rowid)
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS checks_run_time_start ON checks (run_time_start)')
+
+        # Indexes used for the check history of a single accessor or sender
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS checks_accessor ON checks (accessor, run_time_start)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS checks_sender ON checks (sender, run_time_start)')
+
+        # Check counts per sender, result and type are kept up to date by triggers so
+        # that totals never need a full COUNT(*) of the checks table
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS check_counts (sender, result, type, total, UNIQUE (sender, result, type))')
+        self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS checks_count_insert AFTER INSERT ON checks BEGIN
+                INSERT OR IGNORE INTO check_counts VALUES (COALESCE(NEW.sender, ''), NEW.result, NEW.type, 0);
+                UPDATE check_counts SET total = total + 1
+                    WHERE sender = COALESCE(NEW.sender, '') AND result IS NEW.result AND type IS NEW.type;
+            END''')
+        self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS checks_count_delete AFTER DELETE ON checks BEGIN
+                UPDATE check_counts SET total = total - 1
+                    WHERE sender = COALESCE(OLD.sender, '') AND result IS OLD.result AND type IS OLD.type;
+            END''')
+
+        # Set up (or remove) the full-text search index, when no config is given we keep
+        # whatever is already there
+        if config is None:
+            search_index = self.has_search_index()
+        else:
+            try:
+                search_index = config.getboolean('general', 'check_search_index')
+            except Exception as e:
+                search_index = False
+        self.setup_search_index(search_index)
 
         # Run migrations
         self.run_migrations()
 
+    # The search index is an FTS5 table over the output and accessor of the checks
+    # table, kept in sync by triggers. It's optional since not every sqlite3 build
+    # has FTS5 compiled in, searches fall back to LIKE without it.
+    def setup_search_index(self, enabled):
+        self.search_index = None
+
+        if not enabled:
+            self.cursor.execute('DROP TRIGGER IF EXISTS checks_fts_insert')
+            self.cursor.execute('DROP TRIGGER IF EXISTS checks_fts_delete')
+            self.cursor.execute('DROP TABLE IF EXISTS checks_fts')
+            return False
+
+        exists = self.has_search_index()
+        try:
+            self.cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS checks_fts USING fts5(output, accessor, content='checks', content_rowid='rowid')")
+        except sqlite3.OperationalError as e:
+            logging.info("Check search index is not available, using LIKE for searches: %s", e)
+            return False
+
+        self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS checks_fts_insert AFTER INSERT ON checks BEGIN
+                INSERT INTO checks_fts (rowid, output, accessor) VALUES (NEW.rowid, NEW.output, NEW.accessor);
+            END''')
+        self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS checks_fts_delete AFTER DELETE ON checks BEGIN
+                INSERT INTO checks_fts (checks_fts, rowid, output, accessor) VALUES ('delete', OLD.rowid, OLD.output, OLD.accessor);
+            END''')
+
+        # Index the checks that were logged before the index existed
+        if not exists:
+            self.cursor.execute("INSERT INTO checks_fts (checks_fts) VALUES ('rebuild')")
+
+        self.search_index = True
+        return True
+
+    # Returns True if the checks table has a full-text search index
+    def has_search_index(self):
+        if getattr(self, 'search_index', None) is None:
+            self.cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'checks_fts'")
+            self.search_index = self.cursor.fetchone()[0] > 0
+        return self.search_index
+
+    # The index only finds whole words and the start of the last word, so searches
+    # with anything but letters, numbers and spaces (i.e. paths, C:|, %) use LIKE
+    def use_search_index(self, search):
+        return self.has_search_index() and re.match(r'^[^\W_]+( [^\W_]+)*$', search.strip()) is not None
+
+    # Turns the search box text into an FTS5 query, the text is used as a
+    # single phrase with a prefix match on the last word
+    @staticmethod
+    def make_search_query(search):
+        return '"%s" *' % search.replace('"', '""')
+
+    # Removes checks older than check_logging_time from the check log
+    #
+    # Rows are deleted oldest first in small batches with a pause between each batch so
+    # that the listener and passive checks can keep logging checks while this runs.
+    # Returns (and stores) stats about the run.
     def run_db_maintenance(self, config):
         try:
             days = config.getint('general', 'check_logging_time')
         except Exception as e:
             days = 30;
         timestamp = time.time() - (days * 86400)
+
+        stats = { 'run_time_start': time.time(), 'rows_pruned': 0, 'batches': 0,
+                  'busy_time': 0.0, 'max_batch_time': 0.0, 'pages_vacuumed': 0 }
+        batch_size = self.prune_batch_size
+
+        try:
+            while True:
+                batch_start = time.time()
+                self.cursor.execute('DELETE FROM checks WHERE rowid IN (SELECT rowid FROM checks WHERE run_time_start < ? ORDER BY run_time_start LIMIT ?)',
+                                    (timestamp, batch_size))
+                deleted = self.cursor.rowcount
+                batch_time = time.time() - batch_start
+
+                stats['rows_pruned'] += deleted
+                stats['batches'] += 1
+                stats['busy_time'] += batch_time
+                stats['max_batch_time'] = max(stats['max_batch_time'], batch_time)
+
+                if deleted < batch_size:
+                    break
+
+                # Keep each batch close to the target time
+                if batch_time > self.prune_batch_time:
+                    batch_size = max(self.prune_batch_min, batch_size // 2)
+                elif batch_time < self.prune_batch_time / 2:
+                    batch_size = min(self.prune_batch_max, batch_size * 2)
+
+                time.sleep(self.prune_pause)
+
+            stats['pages_vacuumed'] = self.run_incremental_vacuum(stats)
+        except Exception as e:
+            logging.exception(e)
+
+        stats['run_time_end'] = time.time()
+        logging.info("DB maintenance pruned %d checks in %d batches (%.3f s busy, longest batch %.3f s, %d pages vacuumed)",
+                     stats['rows_pruned'], stats['batches'], stats['busy_time'], stats['max_batch_time'], stats['pages_vacuumed'])
+
         try:
-            self.cursor.execute('DELETE FROM checks WHERE run_time_start < %d' % timestamp)
+            self.cursor.execute('INSERT INTO maintenance VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (stats['run_time_start'], stats['run_time_end'], stats['rows_pruned'], stats['batches'],
+                                 stats['busy_time'], stats['max_batch_time'], stats['pages_vacuumed']))
+            self.cursor.execute('DELETE FROM maintenance WHERE run_time_start < ?', (timestamp,))
         except Exception as e:
             logging.exception(e)
 
+        return stats
+
+    # Gives back free pages to the filesystem a few at a time, this only does
+    # something when the database uses incremental auto vacuum
+    def run_incremental_vacuum(self, stats):
+        self.cursor.execute('PRAGMA auto_vacuum')
+        if self.cursor.fetchone()[0] != 2:
+            return 0
+
+        pages = 0
+        while True:
+            self.cursor.execute('PRAGMA freelist_count')
+            free = self.cursor.fetchone()[0]
+            if free < 1:
+                break
+
+            # The pragma frees one page per step, executescript() runs it to the end
+            batch_start = time.time()
+            self.cursor.executescript('PRAGMA incremental_vacuum(%d)' % self.vacuum_batch_pages)
+            batch_time = time.time() - batch_start
+
+            pages += min(free, self.vacuum_batch_pages)
+            stats['busy_time'] += batch_time
+            stats['max_batch_time'] = max(stats['max_batch_time'], batch_time)
+            time.sleep(self.prune_pause)
+
+        return pages
+
+    # Returns the stats from the last DB maintenance run
+    def get_maintenance_stats(self):
+        self.cursor.execute('SELECT * FROM maintenance ORDER BY run_time_start DESC LIMIT 1')
+        obj = self.cursor.fetchone()
+        if obj is None:
+            return None
+        return dict(zip([x[0] for x in self.cursor.description], obj))
+
     # Function that will run migrations in future versions if there needs to be some
     # changes to the database layout
     def run_migrations(self):
-        pass
+        self.cursor.execute('SELECT MAX(id) FROM migrations')
+        current = self.cursor.fetchone()[0] or 0
+
+        # Migration 1: build the check counts for check logs created before they existed
+        if current < 1:
+            try:
+                self.cursor.execute('BEGIN')
+                self.cursor.execute('DELETE FROM check_counts')
+                self.cursor.execute("INSERT INTO check_counts SELECT COALESCE(sender, ''), result, type, COUNT(*) FROM checks GROUP BY 1, 2, 3")
+                self.cursor.execute('INSERT INTO migrations VALUES (?, ?)', (1, listener.server.__VERSION__))
+                self.cursor.execute('COMMIT')
+            except Exception as e:
+                self.cursor.execute('ROLLBACK')
+                logging.exception(e)
 
     # Add a check to the check database
     def add_check(self, accessor, run_time_start, run_time_end, result, output, sender, checktype):
@@ -69,46 +281,94 @@ class DB(object):
         except Exception as ex:
             logging.exception(ex)
 
-    # Returns the total amount of checks in the DB
-    def get_checks_count(self, search='', status='', senders=[]):
-        where = False
+    # Build the where clause and values for the check filters
+    def get_checks_filter(self, search='', status='', ctype='', senders=[]):
+        where = []
         data = ()
-        cmd = "SELECT COUNT(*) FROM checks"
 
         # If we are doing a search... append to the query
         if search != '':
-            data += ("%" + search + "%",)
-            cmd += " WHERE output LIKE ?"
-            where = True
+            if self.use_search_index(search):
+                data += (self.make_search_query(search),)
+                where.append("rowid IN (SELECT rowid FROM checks_fts WHERE checks_fts MATCH ?)")
+            else:
+                data += ("%" + search + "%", "%" + search + "%")
+                where.append("(output LIKE ? OR accessor LIKE ?)")
 
         # Add status where clause
         if status != '':
             data += (status,)
-            if where:
-                cmd += " AND"
-            else:
-                cmd += " WHERE"
-                where = True
-            cmd += " result = ?"
+            where.append("result = ?")
+
+        # Add type
+        if ctype != '':
+            data += (ctype,)
+            where.append("type = ?")
 
         # Add senders
         if len(senders) > 0:
             for sender in senders:
                 data += (sender,)
-            if where:
-                cmd += " AND"
-            else:
-                cmd += " WHERE"
-                where = True
-            cmd += " sender IN (" + ','.join('?'*len(senders)) + ")"
+            where.append("sender IN (" + ','.join('?'*len(senders)) + ")")
 
-        self.cursor.execute(cmd, data)
+        return where, data
+
+    # Returns the total amount of checks in the DB
+    def get_checks_count(self, search='', status='', senders=[], ctype=''):
+
+        # Without a search the total comes straight from the maintained counts
+        if search == '':
+            where, data = self.get_checks_filter('', status, ctype, [x if x is not None else '' for x in senders])
+            cmd = "SELECT COALESCE(SUM(total), 0) FROM check_counts"
+            if where:
+                cmd += " WHERE " + " AND ".join(where)
+            self.cursor.execute(cmd, data)
+            return self.cursor.fetchone()[0]
+
+        # Searches are counted once and then only the rows added since the last
+        # count are counted, unless rows were removed in the meantime
+        where, data = self.get_checks_filter(search, status, ctype, senders)
+        key = (search, status, ctype, tuple(senders))
+        table = "checks"
+
+        # When the search is the only filter we can count in the index directly
+        if self.use_search_index(search) and len(where) == 1:
+            table = "checks_fts"
+            where = ["checks_fts MATCH ?"]
+
+        total = self.get_checks_count()
+        self.cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM checks")
+        max_rowid = self.cursor.fetchone()[0]
+
+        cached = search_counts.get(key)
+        if cached is not None:
+            search_counts.move_to_end(key)
+            count, last_total, last_rowid = cached
+            self.cursor.execute("SELECT COUNT(*) FROM checks WHERE rowid > ?", (last_rowid,))
+            added = self.cursor.fetchone()[0]
+            if last_total + added == total:
+                self.cursor.execute("SELECT COUNT(*) FROM " + table + " WHERE rowid > ? AND rowid <= ? AND " + " AND ".join(where),
+                                    (last_rowid, max_rowid) + data)
+                count += self.cursor.fetchone()[0]
+                self.set_search_count(key, (count, total, max_rowid))
+                return count
+
+        self.cursor.execute("SELECT COUNT(*) FROM " + table + " WHERE rowid <= ? AND " + " AND ".join(where), (max_rowid,) + data)
         count = self.cursor.fetchone()[0]
+        self.set_search_count(key, (count, total, max_rowid))
         return count
 
+    # Save a search count, dropping the least recently used ones over the limit
+    @staticmethod
+    def set_search_count(key, value):
+        search_counts[key] = value
+        search_counts.move_to_end(key)
+        while len(search_counts) > search_counts_max:
+            search_counts.popitem(last=False)
+
     # Returns a list of distinct senders for filtering
     def get_check_senders(self):
-        cmd = "SELECT DISTINCT sender FROM checks"
+        cmd = "SELECT DISTINCT sender FROM check_counts WHERE total > 0 ORDER BY sender"
 
         self.cursor.execute(cmd)
         objs = self.cursor.fetchall()
@@ -119,54 +379,54 @@ class DB(object):
 
         return senders
 
-    # Special functions for getting check results
-    def get_checks(self, search='', size=20, page=1, status='', ctype='', senders=[]):
-        where = False
-        data = ()
-        cmd = "SELECT * FROM checks"
-
-        # If we are doing a search... append to the query
-        if search != '':
-            data += ("%" + search + "%",)
-            cmd += " WHERE output LIKE ?"
-            where = True
-
-        # Add status where clause
-        if status != '':
-            data += (status,)
-            if where:
-                cmd += " AND"
-            else:
-                cmd += " WHERE"
-                where = True
-            cmd += " result = ?"
+    # Cursors for paging through checks are the run_time_start and rowid of
+    # the row on the edge of the page, written as "<run_time_start>:<rowid>"
+    @staticmethod
+    def make_cursor(check):
+        return "%r:%d" % (check['run_time_start'], check['rowid'])
 
-        # Add type
-        if ctype != '':
-            data += (ctype,)
-            if where:
-                cmd += " AND"
-            else:
-                cmd += " WHERE"
-                where = True
-            cmd += " type = ?"
+    @staticmethod
+    def parse_cursor(cursor):
+        try:
+            run_time_start, rowid = cursor.rsplit(':', 1)
+            return float(run_time_start), int(rowid)
+        except (AttributeError, ValueError):
+            return None
 
-        # Add senders
-        if len(senders) > 0:
-            for sender in senders:
-                data += (sender,)
-            if where:
-                cmd += " AND"
-            else:
-                cmd += " WHERE"
-                where = True
-            cmd += " sender IN (" + ','.join('?'*len(senders)) + ")"
+    # Special functions for getting check results
+    #
+    # Pages are selected with a cursor: "before" returns the checks older than the
+    # cursor and "after" the checks newer than it, both newest first. Passing
+    # neither gives the newest checks, and "oldest" gives the last page. The page
+    # number is only used (with an offset) when no cursor was given.
+    def get_checks(self, search='', size=20, page=1, status='', ctype='', senders=[], before=None, after=None, oldest=False):
+        where, data = self.get_checks_filter(search, status, ctype, senders)
+        cmd = "SELECT rowid, * FROM checks"
+        descending = True
+
+        before = self.parse_cursor(before)
+        after = self.parse_cursor(after)
+        if before is not None:
+            where.append("(run_time_start < ? OR (run_time_start = ? AND rowid < ?))")
+            data += (before[0], before[0], before[1])
+        elif after is not None:
+            where.append("(run_time_start > ? OR (run_time_start = ? AND rowid > ?))")
+            data += (after[0], after[0], after[1])
+            descending = False
+        elif oldest:
+            descending = False
+
+        if where:
+            cmd += " WHERE " + " AND ".join(where)
 
         # Apply order by
-        cmd += " ORDER BY run_time_start DESC"
+        if descending:
+            cmd += " ORDER BY run_time_start DESC, rowid DESC"
+        else:
+            cmd += " ORDER BY run_time_start ASC, rowid ASC"
 
         # Apply limiting based on page and size
-        if page < 1:
+        if page < 1 or before is not None or after is not None or oldest:
             page = 1
         start = (page - 1) * size
         limit = "%d,%d" % (start, size)
@@ -177,6 +437,8 @@ class DB(object):
         # Get the requested objects
         objs = self.cursor.fetchall()
         columns = self.cursor.description
+        if not descending:
+            objs.reverse()
 
         # Get a real list of checks
         checks = []
@@ -199,3 +461,63 @@ class DB(object):
             checks.append(check)
 
         return checks
+
+    # Returns aggregated check history for an accessor and/or sender between start
+    # and end: counts per state for each bucket (in seconds), the time spent in each
+    # state, the number of state changes (flaps) and the last N check results.
+    #
+    # Everything is aggregated in SQL using the accessor and sender indexes. Time in
+    # state and flaps use window functions, which need sqlite 3.25 or newer.
+    def get_check_history(self, accessor='', sender='', start=None, end=None, bucket=3600, last=10):
+        if end is None:
+            end = time.time()
+        if start is None:
+            start = end - 86400
+
+        where = ["run_time_start >= ?", "run_time_start < ?"]
+        data = (start, end)
+        if accessor != '':
+            where.insert(0, "accessor = ?")
+            data = (accessor,) + data
+        if sender != '':
+            where.insert(0, "sender = ?")
+            data = (sender,) + data
+        where = " AND ".join(where)
+
+        history = { 'accessor': accessor, 'sender': sender, 'start': start, 'end': end,
+                    'bucket': bucket, 'buckets': [], 'time_in_state': None, 'flaps': None, 'last': [] }
+
+        # State counts per bucket
+        self.cursor.execute("""SELECT CAST(run_time_start / ? AS INTEGER) * ? AS bucket_start,
+                SUM(result = 0), SUM(result = 1), SUM(result = 2), SUM(result NOT IN (0, 1, 2)), COUNT(*)
+                FROM checks WHERE """ + where + " GROUP BY 1 ORDER BY 1", (bucket, bucket) + data)
+        for obj in self.cursor.fetchall():
+            history['buckets'].append({ 'time': obj[0], 'ok': obj[1], 'warning': obj[2],
+                                        'critical': obj[3], 'unknown': obj[4], 'total': obj[5] })
+
+        # Time in each state (until the next result of the same accessor/sender or the end of
+        # the range) and state changes
+        if sqlite3.sqlite_version_info >= (3, 25, 0):
+            history['time_in_state'] = { 'ok': 0, 'warning': 0, 'critical': 0, 'unknown': 0 }
+            history['flaps'] = 0
+            self.cursor.execute("""SELECT CASE WHEN result IN (0, 1, 2) THEN result ELSE 3 END AS state,
+                    SUM(MIN(COALESCE(next_start, ?), ?) - run_time_start), SUM(changed)
+                    FROM (SELECT result, run_time_start,
+                        LEAD(run_time_start) OVER w AS next_start,
+                        COALESCE(LAG(result) OVER w != result, 0) AS changed
+                        FROM checks WHERE """ + where + """
+                        WINDOW w AS (PARTITION BY accessor, sender ORDER BY run_time_start))
+                    GROUP BY 1""", (end, end) + data)
+            names = ['ok', 'warning', 'critical', 'unknown']
+            for obj in self.cursor.fetchall():
+                history['time_in_state'][names[obj[0]]] = round(obj[1], 2)
+                history['flaps'] += obj[2]
+
+        # Last N results
+        if last > 0:
+            self.cursor.execute("SELECT accessor, sender, run_time_start, result, output FROM checks WHERE " + where +
+                                " ORDER BY run_time_start DESC LIMIT ?", data + (last,))
+            columns = [x[0] for x in self.cursor.description]
+            history['last'] = [dict(zip(columns, obj)) for obj in self.cursor.fetchall()]
+
+        return history
@@ -0,0 +1,399 @@
+import os
+import re
+import mmap
+import struct
+import time
+import urllib.parse
+import gevent
+import ncpa
+import listener.psapi as psapi
+
+from ncpa import listener_logger as logging
+
+# A module to keep a short history of selected metrics on the agent itself. Each
+# metric is sampled on a fixed interval into a fixed size ring buffer file which
+# is memory mapped, so the files never grow and the oldest samples are overwritten.
+# Raw samples are also rolled up into 1 minute and 1 hour buckets (min, max, avg
+# and last) which are kept for longer than the raw samples.
+
+# Ring file layout: a 128 byte header followed by capacity records, each record is
+# a timestamp followed by one double for each field. Rollup rings also keep the
+# bucket that is still being filled in the header so it survives restarts.
+HEADER = struct.Struct('<8sIIIQQ16sIdQdddd')
+HEADER_SIZE = 128
+MAGIC = b'NCPAHIST'
+VERSION = 2
+
+# Rollup resolutions, the config option for their retention and the file suffix
+ROLLUPS = [(60, 'minute_retention', '1m'), (3600, 'hour_retention', '1h')]
+ROLLUP_FIELDS = ['min', 'max', 'avg', 'last']
+
+# The series being recorded, keyed by accessor
+series = {}
+recorder = None
+
+
+# Convert a duration like 90, 30m, 12h or 7d into seconds
+def parse_duration(value):
+    match = re.match(r'^\s*(\d+)\s*([smhdw]?)\s*$', str(value).lower())
+    if not match:
+        raise ValueError('Invalid duration: %s' % value)
+    multiplier = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    return int(match.group(1)) * multiplier[match.group(2)]
+
+
+class RingBuffer(object):
+
+    def __init__(self, path, capacity, fields=1, resolution=0):
+        self.path = path
+        self.capacity = capacity
+        self.fields = fields
+        self.width = fields + 1
+        self.resolution = resolution
+        self.unit = ''
+        self.head = 0
+        self.count = 0
+        self.reset_bucket()
+        self.open()
+
+    def size(self):
+        return HEADER_SIZE + self.capacity * self.width * 8
+
+    # Map an existing ring file, if the capacity changed (retention or interval
+    # was edited) the newest records are copied into a new file of the right size.
+    # Files that don't match the size in their header (truncated) are replaced.
+    def open(self):
+        old = None
+        header = self.read_header()
+        if header is not None:
+            capacity, fields, resolution = header[2], header[3], header[7]
+            if (fields, resolution) == (self.fields, self.resolution):
+                if os.path.getsize(self.path) != HEADER_SIZE + capacity * (fields + 1) * 8:
+                    logging.warning('Replacing damaged metric history file %s', self.path)
+                elif capacity == self.capacity:
+                    self.map()
+                    return
+                else:
+                    old = RingBuffer(self.path, capacity, fields, resolution)
+        elif os.path.isfile(self.path):
+            logging.warning('Replacing invalid metric history file %s', self.path)
+
+        if old is None:
+            self.create()
+            return
+
+        # Only the finished records are copied, the bucket still being rolled up
+        # is carried over as the bucket state
+        records = [tuple(old.data[old.offset(i):old.offset(i) + old.width].tolist()) for i in range(old.count)]
+        self.unit = old.unit
+        self.bucket, self.samples = old.bucket, old.samples
+        self.low, self.high, self.total, self.last = old.low, old.high, old.total, old.last
+        old.close()
+
+        self.create()
+        for record in records[-self.capacity:]:
+            self.append(record[0], record[1:])
+
+    def read_header(self):
+        try:
+            with open(self.path, 'rb') as f:
+                header = HEADER.unpack(f.read(HEADER.size))
+        except (IOError, OSError, struct.error):
+            return None
+        if header[0] != MAGIC or header[1] != VERSION:
+            return None
+        return header
+
+    def create(self):
+        with open(self.path, 'wb') as f:
+            f.truncate(self.size())
+        self.map()
+        self.write_header()
+
+    def map(self):
+        self.file = open(self.path, 'r+b')
+        self.mmap = mmap.mmap(self.file.fileno(), self.size())
+        self.data = memoryview(self.mmap)[HEADER_SIZE:].cast('d')
+        header = HEADER.unpack_from(self.mmap)
+        if header[0] != MAGIC:
+            return
+        self.head, self.count = header[4], header[5]
+        self.unit = header[6].rstrip(b'\0').decode('utf-8', 'replace')
+        self.bucket, self.samples = header[8], header[9]
+        self.low, self.high, self.total, self.last = header[10:14]
+
+    def write_header(self):
+        HEADER.pack_into(self.mmap, 0, MAGIC, VERSION, self.capacity, self.fields,
+                         self.head, self.count, self.unit.encode('utf-8')[:16],
+                         self.resolution, self.bucket, self.samples,
+                         self.low, self.high, self.total, self.last)
+
+    def set_unit(self, unit):
+        self.unit = unit or ''
+        self.write_header()
+
+    def close(self):
+        self.data.release()
+        self.mmap.flush()
+        self.mmap.close()
+        self.file.close()
+
+    # Position of the i-th oldest record in the data array
+    def offset(self, i):
+        return ((self.head - self.count + i) % self.capacity) * self.width
+
+    def timestamp(self, i):
+        return self.data[self.offset(i)]
+
+    def last_timestamp(self):
+        if not self.count:
+            return None
+        return self.timestamp(self.count - 1)
+
+    # Records must be added in time order so reads can binary search the ring,
+    # anything older than the newest record (clock changes) is dropped
+    def append(self, timestamp, values):
+        last = self.last_timestamp()
+        if last is not None and timestamp <= last:
+            return False
+
+        base = self.head * self.width
+        self.data[base] = timestamp
+        for i in range(self.fields):
+            self.data[base + 1 + i] = values[i]
+
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.write_header()
+        return True
+
+    def reset_bucket(self):
+        self.bucket = 0
+        self.samples = 0
+        self.low = self.high = self.total = self.last = 0
+
+    # Add a sample to the bucket being rolled up, the bucket is written to the ring
+    # once a sample arrives for a later bucket
+    def add_sample(self, timestamp, value):
+        bucket = timestamp - timestamp % self.resolution
+        if self.samples and bucket != self.bucket:
+            if bucket < self.bucket:
+                return False
+            self.append(self.bucket, self.get_bucket()[1:])
+            self.reset_bucket()
+
+        if not self.samples:
+            self.bucket = bucket
+            self.low = self.high = value
+        self.samples += 1
+        self.low = min(self.low, value)
+        self.high = max(self.high, value)
+        self.total += value
+        self.last = value
+        self.write_header()
+        return True
+
+    # The (timestamp, min, max, avg, last) record for the bucket being rolled up
+    def get_bucket(self):
+        if not self.samples:
+            return None
+        return (self.bucket, self.low, self.high, self.total / self.samples, self.last)
+
+    def oldest_timestamp(self):
+        if not self.count:
+            return None
+        return self.timestamp(0)
+
+    # Index of the oldest record at or after timestamp
+    def find(self, timestamp):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Get the (timestamp, value, ...) records between start and end in time order
+    def records(self, start=None, end=None):
+        records = []
+        i = self.find(start) if start is not None else 0
+        while i < self.count:
+            offset = self.offset(i)
+            if end is not None and self.data[offset] > end:
+                break
+            records.append(tuple(self.data[offset:offset + self.width].tolist()))
+            i += 1
+
+        # Rollups include the bucket that is still being filled
+        bucket = self.get_bucket() if self.resolution else None
+        if bucket and (start is None or bucket[0] >= start) and (end is None or bucket[0] <= end):
+            records.append(bucket)
+        return records
+
+
+class Series(object):
+
+    def __init__(self, directory, accessor, interval, retention, rollups):
+        self.accessor = accessor
+        self.interval = interval
+        name = os.path.join(directory, urllib.parse.quote(accessor, safe=''))
+
+        # Rings are ordered from the finest to the coarsest resolution, rollups
+        # that are not coarser than the sample interval are skipped and the
+        # samples are kept for their retention instead
+        for resolution, suffix, rollup_retention in rollups:
+            if resolution <= interval:
+                retention = max(retention, rollup_retention)
+        self.rings = [RingBuffer(name + '.hist', max(1, retention // interval))]
+        for resolution, suffix, retention in rollups:
+            if resolution > interval and retention:
+                capacity = max(1, retention // resolution)
+                path = '%s.%s.hist' % (name, suffix)
+                self.rings.append(RingBuffer(path, capacity, len(ROLLUP_FIELDS), resolution))
+
+    @property
+    def unit(self):
+        return self.rings[0].unit
+
+    def set_unit(self, unit):
+        for ring in self.rings:
+            ring.set_unit(unit)
+
+    def append(self, timestamp, value):
+        if not self.rings[0].append(timestamp, [value]):
+            return False
+        for ring in self.rings[1:]:
+            ring.add_sample(timestamp, value)
+        return True
+
+    def close(self):
+        for ring in self.rings:
+            ring.close()
+
+    # Use the finest resolution that still has data back to start and returns
+    # at most points records, falling back to the coarsest resolution
+    def get_ring(self, start, end, points=None):
+        rings = [x for x in self.rings if x.count < x.capacity or x.oldest_timestamp() <= start]
+        if not rings:
+            rings = self.rings[-1:]
+        if points:
+            for ring in rings:
+                if (end - start) / (ring.resolution or self.interval) <= points:
+                    return ring
+            return rings[-1]
+        return rings[0]
+
+
+class Recorder(object):
+
+    def __init__(self, config, directory):
+        self.config = config
+        self.directory = directory
+        self.interval = max(1, parse_duration(config.get('metric history', 'interval')))
+        self.retention = parse_duration(config.get('metric history', 'retention'))
+        self.rollups = []
+        for resolution, option, suffix in ROLLUPS:
+            retention = parse_duration(config.get('metric history', option))
+            self.rollups.append((resolution, suffix, retention))
+
+        # Accessors can have arguments, i.e. interface/eth0/bytes_sent?delta=1
+        self.metrics = {}
+        for item in config.get('metric history', 'accessors').split(','):
+            accessor, _, query = item.strip().partition('?')
+            accessor = accessor.strip('/')
+            if not accessor:
+                continue
+            args = {}
+            for name, value in urllib.parse.parse_qsl(query):
+                args.setdefault(name, []).append(value)
+            self.metrics[accessor] = args
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        for accessor in self.metrics:
+            series[accessor] = Series(self.directory, accessor, self.interval, self.retention, self.rollups)
+
+    # Sample all the recorded accessors, metrics that return more than one value
+    # (like cpu/percent) are stored as the average unless an aggregate is given
+    def sample(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        roots = {}
+        for accessor, args in self.metrics.items():
+            path = psapi.split_accessor(accessor)
+            kwargs = dict(args, accessor=accessor, config=self.config, remote_addr='history')
+            try:
+                if path[0] not in roots:
+                    roots[path[0]] = psapi.get_path_node(self.config, path[0])
+                roots[path[0]].reset_valid_nodes()
+                node = roots[path[0]].accessor(path, self.config, '/api/' + accessor, args)
+                values, unit = node.get_values(**kwargs)
+            except AttributeError:
+                logging.warning('Metric history can only record a single metric, skipping: %s', accessor)
+                continue
+            except Exception as e:
+                logging.exception(e)
+                continue
+
+            values = [x for x in values if isinstance(x, (int, float))]
+            if not values:
+                continue
+
+            metric = series[accessor]
+            if node.unit != metric.unit:
+                metric.set_unit(node.unit)
+            metric.append(timestamp, sum(values) / len(values))
+
+    # Sample on interval boundaries so every series shares the same timestamps
+    def run(self):
+        logging.info('Recording metric history for %s every %d seconds', ', '.join(self.metrics), self.interval)
+        while True:
+            now = time.time()
+            tick = (int(now) // self.interval + 1) * self.interval
+            gevent.sleep(tick - now)
+            try:
+                self.sample(tick)
+            except Exception as e:
+                logging.exception(e)
+
+
+# Start the recorder in the background if it is enabled in the config
+def start(config):
+    global recorder
+
+    try:
+        if not config.getboolean('metric history', 'enabled'):
+            return None
+        recorder = Recorder(config, ncpa.get_filename(os.path.join('var', 'history')))
+    except Exception as e:
+        logging.exception('Could not start metric history: %s', e)
+        return None
+
+    return gevent.spawn(recorder.run)
+
+
+# Get the recorded history for the last duration seconds, the resolution is picked
+# based on the range and the maximum number of points wanted
+def get_history(accessor, duration, points=None, end=None):
+    metric = series.get(accessor.strip('/'))
+    if metric is None:
+        return None
+
+    if end is None:
+        end = time.time()
+    start = end - duration
+    ring = metric.get_ring(start, end, points)
+
+    return {
+        'accessor': metric.accessor,
+        'resolution': ring.resolution or metric.interval,
+        'fields': ROLLUP_FIELDS if ring.resolution else ['value'],
+        'unit': metric.unit,
+        'start': start,
+        'end': end,
+        'values': [list(x) for x in ring.records(start, end)],
+    }
@@ -0,0 +1,456 @@
+import os
+import bisect
+import collections
+import signal
+import subprocess
+import time
+import gevent
+import gevent.event
+import gevent.lock
+import listener.environment as environment
+import listener.pluginworkers as pluginworkers
+import listener.server as server
+from ncpa import listener_logger as logging
+
+# Plugins are run with their own concurrency limit, separate from the pool serving
+# HTTP requests (max_connections). At most plugin_concurrency plugins are run at
+# once (and fewer for plugins in plugin_concurrency_limits), other requests wait in
+# a queue of at most plugin_queue_size requests for up to plugin_queue_timeout
+# seconds and requests that don't fit are answered with UNKNOWN right away. So
+# plugin requests never hold more than plugin_concurrency + plugin_queue_size HTTP
+# connections and the rest are left for other API calls, even when plugins hang.
+# Timeouts are handled with gevent timers instead of a thread for each plugin.
+#
+# Results can be cached for plugins in plugin_cache_ttl (or with cache_ttl on the
+# request) by command line, and identical command lines that are run at the same
+# time are only run once with the result given to all of them. Requests waiting on
+# another request's run are counted in the queue like any other waiting request.
+#
+# Output is read while the plugin runs and at most plugin_output_max bytes of it
+# are kept, anything after that is read and thrown away and the result is marked as
+# truncated. This keeps a plugin that writes too much from using up the memory of
+# the listener. plugin_stderr sets whether stderr is merged into the output, kept
+# separate or thrown away.
+#
+# Run times, timeouts, exit codes and output sizes are kept in memory for each
+# plugin (and all plugins) and shown at /api/agent/plugins/stats to find the
+# plugins that are slowing the agent down.
+
+# How much of a plugin's output is read at a time
+CHUNK_SIZE = 65536
+
+STDERR_MODES = ("merge", "separate", "discard")
+
+# Upper bounds in seconds of the run time histogram buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Number of recent run times kept for each plugin to get the percentiles from
+LATENCY_SAMPLES = 1000
+
+
+class PluginResult(object):
+    def __init__(self, stdout, returncode, killed, run_time_start, run_time_end, rejected=False,
+                 stderr=None, truncated=False):
+        self.stdout = stdout
+        self.returncode = returncode
+        self.killed = killed
+        self.run_time_start = run_time_start
+        self.run_time_end = run_time_end
+        self.rejected = rejected
+        self.stderr = stderr
+        self.truncated = truncated
+
+
+# Queue and run counts for a plugin (or all plugins)
+class PluginQueueStats(object):
+    def __init__(self):
+        self.running = 0
+        self.waiting = 0
+        self.runs = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def add_wait(self, wait):
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self):
+        started = self.runs + self.timed_out
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "runs": self.runs,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait": round(self.total_wait / started, 3) if started else 0,
+            "max_wait": round(self.max_wait, 3),
+        }
+
+
+# Run time, timeout, exit code and output counts for a plugin (or all plugins)
+class PluginRunStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.cached = 0
+        self.timeouts = 0
+        self.truncated = 0
+        self.exit_codes = collections.Counter()
+        self.output_bytes = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.samples = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def add_run(self, result):
+        run_time = max(0, result.run_time_end - result.run_time_start)
+        self.calls += 1
+        self.total_time += run_time
+        self.max_time = max(self.max_time, run_time)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, run_time)] += 1
+        self.samples.append(run_time)
+        self.output_bytes += len(result.stdout or "") + len(result.stderr or "")
+        if result.truncated:
+            self.truncated += 1
+        if result.killed:
+            self.timeouts += 1
+        else:
+            self.exit_codes[result.returncode] += 1
+
+    # Get a percentile of the sorted recent run times (nearest rank)
+    @staticmethod
+    def get_percentile(samples, percent):
+        if not samples:
+            return 0
+        return round(samples[max(0, int(len(samples) * percent / 100.0 + 0.5) - 1)], 3)
+
+    def as_dict(self):
+        samples = sorted(self.samples)
+        buckets = dict(("le_%s" % bound, count) for bound, count in zip(LATENCY_BUCKETS, self.buckets))
+        buckets["le_inf"] = self.buckets[-1]
+        return {
+            "calls": self.calls,
+            "cached": self.cached,
+            "timeouts": self.timeouts,
+            "truncated": self.truncated,
+            "exit_codes": dict((str(code), count) for code, count in sorted(self.exit_codes.items())),
+            "output_bytes": self.output_bytes,
+            "latency": {
+                "avg": round(self.total_time / self.calls, 3) if self.calls else 0,
+                "max": round(self.max_time, 3),
+                "p50": self.get_percentile(samples, 50),
+                "p95": self.get_percentile(samples, 95),
+                "p99": self.get_percentile(samples, 99),
+                "histogram": buckets,
+            },
+        }
+
+
+class PluginExecutor(object):
+    def __init__(self):
+        self.semaphore = None
+        self.semaphore_size = None
+        self.limits = {}
+        self.semaphores = {}
+        self.total = PluginQueueStats()
+        self.stats = {}
+        self.run_total = PluginRunStats()
+        self.run_stats = {}
+        self.cache = {}
+        self.running = {}
+
+    @staticmethod
+    def get_option(option, default, convert=int):
+        try:
+            value = server.get_config_value("plugin directives", option, default)
+            return convert(value)
+        except (TypeError, ValueError):
+            return default
+
+    def get_concurrency(self):
+        return max(1, self.get_option("plugin_concurrency", 20))
+
+    # The most bytes of output to keep from a plugin, 0 for no limit
+    def get_output_limit(self):
+        return max(0, self.get_option("plugin_output_max", 1048576))
+
+    def get_stderr_mode(self):
+        mode = str(server.get_config_value("plugin directives", "plugin_stderr", "merge") or "merge").strip().lower()
+        if mode not in STDERR_MODES:
+            logging.warning("Invalid plugin_stderr value %r, using merge", mode)
+            return "merge"
+        return mode
+
+    # Parse a list of plugin:value items like plugin_concurrency_limits
+    @staticmethod
+    def get_plugin_values(option, convert=int):
+        values = {}
+        for item in str(server.get_config_value("plugin directives", option, "") or "").split(","):
+            name, _, value = item.strip().rpartition(":")
+            if environment.SYSTEM == "Windows":
+                name = name.lower()
+            try:
+                values[name] = convert(value)
+            except ValueError:
+                if item.strip():
+                    logging.warning("Invalid value in %s: %s", option, item.strip())
+        return values
+
+    # Parse plugin_concurrency_limits, i.e. check_mysql.py:2, check_raid.sh:1
+    def get_limits(self):
+        return dict((name, max(1, limit)) for name, limit in self.get_plugin_values("plugin_concurrency_limits").items())
+
+    # Get the seconds to cache the results of a plugin, from the request or the
+    # plugin_cache_ttl option, i.e. check_raid.sh:300, check_smart.sh:600
+    def get_cache_ttl(self, name, request_ttl=None):
+        if isinstance(request_ttl, list):
+            request_ttl = request_ttl[0] if request_ttl else None
+        if request_ttl is not None:
+            try:
+                return max(0, float(request_ttl))
+            except ValueError:
+                pass
+        return max(0, self.get_plugin_values("plugin_cache_ttl", float).get(name, 0))
+
+    # The semaphores are made again when the limits are changed, plugins that are
+    # already running release the old ones
+    def get_semaphore(self, name):
+        concurrency = self.get_concurrency()
+        if self.semaphore is None or self.semaphore_size != concurrency:
+            self.semaphore = gevent.lock.Semaphore(concurrency)
+            self.semaphore_size = concurrency
+
+        limits = self.get_limits()
+        if limits != self.limits:
+            self.limits = limits
+            self.semaphores = {}
+        if name in limits and name not in self.semaphores:
+            self.semaphores[name] = gevent.lock.Semaphore(limits[name])
+        return self.semaphore, self.semaphores.get(name)
+
+    def get_stats(self, name):
+        if name not in self.stats:
+            self.stats[name] = PluginQueueStats()
+        return self.stats[name]
+
+    def get_run_stats(self, name):
+        if name not in self.run_stats:
+            self.run_stats[name] = PluginRunStats()
+        return self.run_stats[name]
+
+    # The run stats for all plugins, slowest (by p95) first
+    def get_plugin_stats(self):
+        plugins = [(name, stats.as_dict()) for name, stats in self.run_stats.items()]
+        plugins.sort(key=lambda x: x[1]["latency"]["p95"], reverse=True)
+        return {
+            "total": self.run_total.as_dict(),
+            "plugins": collections.OrderedDict(plugins),
+        }
+
+    def get_queue_stats(self):
+        return {
+            "concurrency": self.get_concurrency(),
+            "limits": self.get_limits(),
+            "queue_size": self.get_option("plugin_queue_size", 100),
+            "queue_timeout": self.get_option("plugin_queue_timeout", 30, float),
+            "total": self.total.as_dict(),
+            "plugins": dict((name, stats.as_dict()) for name, stats in self.stats.items()),
+        }
+
+    # Check if there is room in the queue, the request is counted as rejected and
+    # an UNKNOWN result is returned if there isn't
+    def reject_if_full(self, name, stats):
+        if self.total.waiting < self.get_option("plugin_queue_size", 100):
+            return None
+        for x in stats:
+            x.rejected += 1
+        logging.warning("Plugin queue is full, not running %s", name)
+        return PluginResult("UNKNOWN: Plugin queue is full, %s was not run" % name, 3, False, time.time(), time.time(), True)
+
+    # Run a plugin unless the same command line has a result that is newer than
+    # ttl seconds, or is already running in which case that result is used. Returns
+    # the result and its age in seconds (None if it was run for this request).
+    def run_cached(self, cmd, timeout, name=None, ttl=0, plugin_path=None):
+        key = tuple(cmd)
+
+        cached = self.cache.get(key)
+        if ttl and cached is not None and time.time() - cached[0] < ttl:
+            self.add_cached(name)
+            return cached[1], time.time() - cached[0]
+
+        running = self.running.get(key)
+        if running is not None:
+            stats = [self.total, self.get_stats(name)]
+            rejected = self.reject_if_full(name, stats)
+            if rejected is not None:
+                return rejected, None
+
+            for x in stats:
+                x.waiting += 1
+            try:
+                result = running.get()
+            finally:
+                for x in stats:
+                    x.waiting -= 1
+            self.add_cached(name)
+            return result, time.time() - result.run_time_end
+
+        self.running[key] = running = gevent.event.AsyncResult()
+        try:
+            result = self.run(cmd, timeout, name, plugin_path)
+        except Exception as exc:
+            running.set_exception(exc)
+            raise
+        else:
+            running.set(result)
+        finally:
+            del self.running[key]
+
+        if ttl and not result.killed and not result.rejected:
+            self.cache[key] = (result.run_time_end, result, ttl)
+        self.prune_cache()
+        return result, None
+
+    def add_cached(self, name):
+        for x in (self.run_total, self.get_run_stats(name)):
+            x.cached += 1
+
+    # Remove the cached results that are too old to be used
+    def prune_cache(self):
+        now = time.time()
+        for key, (cached, result, ttl) in list(self.cache.items()):
+            if now - cached >= ttl:
+                del self.cache[key]
+
+    # Wait for a free slot for the plugin (and for all plugins), returns the
+    # semaphores that were acquired or None if the wait timed out
+    def acquire(self, name, deadline):
+        acquired = []
+        for semaphore in reversed(self.get_semaphore(name)):
+            if semaphore is None:
+                continue
+            if not semaphore.acquire(timeout=max(0, deadline - time.time())):
+                for x in acquired:
+                    x.release()
+                return None
+            acquired.append(semaphore)
+        return acquired
+
+    def run(self, cmd, timeout, name=None, plugin_path=None):
+        stats = [self.total, self.get_stats(name)]
+        rejected = self.reject_if_full(name, stats)
+        if rejected is not None:
+            return rejected
+
+        queued = time.time()
+        for x in stats:
+            x.waiting += 1
+        try:
+            acquired = self.acquire(name, queued + self.get_option("plugin_queue_timeout", 30, float))
+        finally:
+            for x in stats:
+                x.waiting -= 1
+                x.add_wait(time.time() - queued)
+
+        if acquired is None:
+            for x in stats:
+                x.timed_out += 1
+            logging.warning("Timed out waiting to run %s in the plugin queue", name)
+            return PluginResult("UNKNOWN: Timed out waiting to run %s in the plugin queue" % name, 3, False, queued, time.time(), True)
+
+        for x in stats:
+            x.running += 1
+            x.runs += 1
+        try:
+            result = self.execute(cmd, timeout, plugin_path)
+            for x in (self.run_total, self.get_run_stats(name)):
+                x.add_run(result)
+            return result
+        finally:
+            for x in stats:
+                x.running -= 1
+            for semaphore in acquired:
+                semaphore.release()
+
+    # Run the plugin in a new process, or in a Python worker when it supports them
+    def execute(self, cmd, timeout, plugin_path=None):
+        run_time_start = time.time()
+        limit = self.get_output_limit()
+        stderr_mode = self.get_stderr_mode()
+
+        worker = pluginworkers.get_worker_command(cmd, plugin_path) if plugin_path else None
+        if worker is not None:
+            stdout, stderr, returncode, killed, truncated = pluginworkers.run(worker[0], worker[1], timeout, limit, stderr_mode)
+            return PluginResult(stdout, returncode, killed, run_time_start, time.time(), stderr=stderr, truncated=truncated)
+
+        options = {}
+        if environment.SYSTEM != "Windows":
+            options["preexec_fn"] = os.setsid
+        stderr = {"merge": subprocess.STDOUT, "separate": subprocess.PIPE, "discard": subprocess.DEVNULL}[stderr_mode]
+        running_check = subprocess.Popen(cmd, bufsize=0, stdout=subprocess.PIPE, stderr=stderr, **options)
+
+        streams = [x for x in (running_check.stdout, running_check.stderr) if x is not None]
+        readers = [gevent.spawn(self.read_output, x, limit) for x in streams]
+
+        # Like communicate(), the plugin times out if it hasn't exited and closed
+        # its output (i.e. something it started still has it open) in time
+        killed = len(gevent.joinall(readers, timeout=timeout)) < len(readers)
+        if not killed:
+            try:
+                running_check.wait(timeout=max(0, run_time_start + timeout - time.time()))
+            except subprocess.TimeoutExpired:
+                killed = True
+
+        if killed:
+            self.kill(running_check)
+            gevent.joinall(readers, timeout=1)
+            gevent.killall(readers)
+            running_check.wait()
+        for stream in streams:
+            stream.close()
+
+        outputs = [x.value if x.successful() else (b"", False) for x in readers]
+        return PluginResult(
+            outputs[0][0],
+            running_check.returncode,
+            killed,
+            run_time_start,
+            time.time(),
+            stderr=outputs[1][0] if len(outputs) > 1 else None,
+            truncated=any(x[1] for x in outputs),
+        )
+
+    # Read a plugin's output as it is written keeping at most limit bytes (0 for no
+    # limit), the rest is read and thrown away so the plugin isn't stuck writing to
+    # a full pipe. Returns the output and whether it was truncated.
+    @staticmethod
+    def read_output(stream, limit):
+        chunks = []
+        size = 0
+        truncated = False
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if limit and size + len(chunk) > limit:
+                chunk = chunk[:max(0, limit - size)]
+                truncated = True
+            if chunk:
+                chunks.append(chunk)
+                size += len(chunk)
+        return b"".join(chunks), truncated
+
+    # Kill the plugin and anything it started
+    @staticmethod
+    def kill(process):
+        try:
+            if environment.SYSTEM == "Windows":
+                process.kill()
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except OSError as exc:
+            logging.debug("Could not kill plugin process %s: %r", process.pid, exc)
+
+
+executor = PluginExecutor()
@@ -10,9 +10,8 @@ import listener.nodes as nodes
 import listener.database as database
 import listener.environment as environment
 import listener.server as server
+import listener.pluginexecutor as pluginexecutor
 from ncpa import listener_logger as logging
-import signal
-from threading import Timer
 
 
 # Windows does not have the pwd and grp module and does not need it since only Unix
@@ -28,6 +27,10 @@ except ImportError:
     pass
 
 
+# Matches \r\n and \r so plugin output can be normalized to \n in one pass
+newlines = re.compile(r"\r\n?")
+
+
 class PluginNode(nodes.RunnableNode):
     def __init__(self, plugin, plugin_abs_path, *args, **kwargs):
         self.name = plugin
@@ -76,13 +79,6 @@ class PluginNode(nodes.RunnableNode):
             logging.error("Error processing plugin instructions: %r\nAttempting to run: %r", e, self.name)
             return "$plugin_name $plugin_args"
 
-    def kill_proc(self, p, t):
-        self.killed = True
-        if environment.SYSTEM == "Windows":
-            p.kill()
-        else:
-            os.killpg(p.pid, signal.SIGKILL)
-
     def execute_plugin(self, config, *args, **kwargs):
         """Runs custom scripts that MUST be located in the scripts subdirectory
         of the executable
@@ -115,32 +111,16 @@ class PluginNode(nodes.RunnableNode):
         cmd = self.get_cmdline(instructions, sudo_plugins)
         logging.debug("Running process with command line: `%s`", " ".join(cmd))
 
-        # Run the command in a new subprocess
-        run_time_start = time.time()
-
-        if environment.SYSTEM == "Windows":
-            running_check = subprocess.Popen(
-                cmd, bufsize=-1, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-            )
-        else:
-            running_check = subprocess.Popen(
-                cmd,
-                bufsize=-1,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                preexec_fn=os.setsid,
-            )
-
-        timer = Timer(timeout, self.kill_proc, [running_check, timeout])
-
-        try:
-            timer.start()
-            stdout, stderr = running_check.communicate()
-        finally:
-            timer.cancel()
-
-        run_time_end = time.time()
-        returncode = running_check.returncode
+        # Run the command in the plugin executor, unless there is a cached result
+        ttl = pluginexecutor.executor.get_cache_ttl(self.name, kwargs.get("cache_ttl"))
+        result, cache_age = pluginexecutor.executor.run_cached(cmd, timeout, self.name, ttl, self.plugin_abs_path)
+        self.killed = result.killed
+        stdout = result.stdout
+        returncode = result.returncode
+        run_time_start = result.run_time_start
+        run_time_end = result.run_time_end
+        if cache_age is not None:
+            run_time_start = run_time_end = time.time()
 
         # In case the plugin call timed out, set stdout and returncode to an error
         if self.killed:
@@ -150,17 +130,10 @@ class PluginNode(nodes.RunnableNode):
             returncode = -1
             logging.error(stdout)
 
-        if isinstance(stdout, bytes):
-            str_stdout = stdout.decode("utf-8", "ignore")
-        else:
-            str_stdout = stdout
-
-        cleaned_stdout = str(
-            str_stdout
-            .replace("\r\n", "\n")
-            .replace("\r", "\n")
-            .strip()
-        )
+        cleaned_stdout = self.clean_output(stdout)
+        if result.truncated and not self.killed:
+            cleaned_stdout += "\n... output truncated at %d bytes" % pluginexecutor.executor.get_output_limit()
+            logging.warning("Output of plugin %s was truncated", self.name)
 
         if not server.__INTERNAL__ and check_logging == 1:
             db = database.DB()
@@ -179,9 +152,20 @@ class PluginNode(nodes.RunnableNode):
         # If debug=1 or true then show the command we ran
         if kwargs["debug"]:
             output["cmd"] = " ".join(cmd)
+            if cache_age is not None:
+                output["cache_age"] = round(cache_age, 2)
+            if result.stderr is not None:
+                output["stderr"] = self.clean_output(result.stderr)
 
         return output
 
+    # Decode plugin output and use \n for all line endings
+    @staticmethod
+    def clean_output(output):
+        if isinstance(output, bytes):
+            output = output.decode("utf-8", "ignore")
+        return newlines.sub("\n", output).strip()
+
     def get_cmdline(self, instruction, sudo_plugins):
         """Execute with special instructions.
 
@@ -223,44 +207,107 @@ class PluginNode(nodes.RunnableNode):
         return command
 
 
-class PluginAgentNode(nodes.ParentNode):
-    def __init__(self, name, *args, **kwargs):
-        self.name = name
-
-    def setup_plugin_children(self, config):
-        plugin_path = config.get("plugin directives", "plugin_path")
-
-        # Get the follow_symlinks value
+# Index of the plugins in the plugin directory so it isn't walked for every plugin
+# call. The modification time of every directory in the tree is kept and the index
+# is only rebuilt when one of them changes (a plugin or folder was added, removed
+# or renamed) or the plugin path or follow_symlinks setting changed. Directories
+# changed within a second of the walk may change again without a new mtime (the
+# timestamp resolution of some filesystems) so the index isn't trusted until then.
+class PluginIndex(object):
+    def __init__(self):
+        self.key = None
+        self.settled = False
+        self.plugins = {}
+        self.names = []
+        self.directories = {}
+
+    @staticmethod
+    def get_mtime(directory):
         try:
-            follow_symlinks = config.getboolean("plugin directives", "follow_symlinks")
-        except Exception as e:
-            follow_symlinks = False
-
-        self.children = {}
+            return os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+
+    def is_current(self, plugin_path, follow_symlinks):
+        if self.key != (plugin_path, follow_symlinks) or not self.settled:
+            return False
+        for directory, mtime in self.directories.items():
+            if self.get_mtime(directory) != mtime:
+                return False
+        return True
+
+    def build(self, plugin_path, follow_symlinks):
+        started = time.time_ns()
+        plugins = {}
+        directories = {plugin_path: self.get_mtime(plugin_path)}
 
         try:
             for root, dirs, files in os.walk(plugin_path, followlinks=follow_symlinks):
+                directories[root] = self.get_mtime(root)
                 for plugin in files:
                     if plugin == ".keep":
                         continue
                     plugin_abs_path = os.path.join(root, plugin)
                     if os.path.isfile(plugin_abs_path):
                         if environment.SYSTEM == "Windows":
-                            self.children[plugin.lower()] = PluginNode(plugin, plugin_abs_path)
+                            plugins[plugin.lower()] = plugin_abs_path
                         else:
-                            self.children[plugin] = PluginNode(plugin, plugin_abs_path)
+                            plugins[plugin] = plugin_abs_path
         except OSError as exc:
             logging.warning("Unable to access directory %s", plugin_path)
             logging.warning(
                 "Unable to assemble plugins. Does the directory exist? - %r", exc
             )
+            directories = {}
+
+        # Partial results are rebuilt on the next call
+        self.key = (plugin_path, follow_symlinks) if directories else None
+        self.plugins = plugins
+        self.names = sorted(plugins)
+        self.directories = directories
+        self.settled = all(x is None or x < started - 10**9 for x in directories.values())
+        return plugins
+
+    def get_plugins(self, plugin_path, follow_symlinks):
+        if not self.is_current(plugin_path, follow_symlinks):
+            return self.build(plugin_path, follow_symlinks)
+        return self.plugins
+
+
+index = PluginIndex()
+
+
+class PluginAgentNode(nodes.ParentNode):
+    def __init__(self, name, *args, **kwargs):
+        self.name = name
+
+    def get_plugins(self, config):
+        plugin_path = config.get("plugin directives", "plugin_path")
+
+        # Get the follow_symlinks value
+        try:
+            follow_symlinks = config.getboolean("plugin directives", "follow_symlinks")
+        except Exception as e:
+            follow_symlinks = False
+
+        return index.get_plugins(plugin_path, follow_symlinks)
+
+    # Make the plugin nodes from the plugin index, only for the plugin being run
+    # when it exists (plugin nodes keep their arguments so they aren't reused)
+    def setup_plugin_children(self, config, name=None):
+        plugins = self.get_plugins(config)
+        if name is not None and environment.SYSTEM == "Windows":
+            name = name.lower()
+        names = [name] if name in plugins else plugins
+
+        self.children = {}
+        for plugin in names:
+            self.children[plugin] = PluginNode(os.path.basename(plugins[plugin]), plugins[plugin])
 
     def accessor(self, path, config, full_path, args):
-        self.setup_plugin_children(config)
+        self.setup_plugin_children(config, path[0] if path else None)
         return super(PluginAgentNode, self).accessor(path, config, full_path, args)
 
     def walk(self, *args, **kwargs):
-        self.setup_plugin_children(kwargs["config"])
-        plugins = list(self.children.keys())
-        plugins.sort()
-        return {self.name: plugins}
+        self.get_plugins(kwargs["config"])
+        return {self.name: list(index.names)}
@@ -0,0 +1,225 @@
+import os
+import json
+import signal
+import subprocess
+import gevent
+import gevent.lock
+import listener.environment as environment
+import listener.server as server
+from ncpa import listener_logger as logging
+
+# Long running Python interpreters that run Python plugins so each check doesn't
+# pay for starting the interpreter and importing modules again. This is opt-in,
+# python_workers in [plugin directives] sets the number of workers and only plugins
+# with a "# ncpa: worker" line near the top are run in them.
+#
+# Each worker runs one plugin at a time with runpy as __main__ with sys.argv set
+# to the plugin and its arguments, like running the plugin from the command line.
+# The output and exit code are sent back as a line of JSON. A worker is killed when
+# a plugin times out and replaced when it dies, so one bad plugin only ever takes
+# down its own worker.
+
+MARKER = b"# ncpa: worker"
+
+# Workers are replaced after this many runs in case plugins leak memory
+MAX_RUNS = 1000
+
+# The worker itself, passed to the interpreter with -c so it works the same way
+# when the agent is frozen. The original stdin and stdout are kept for talking to
+# the agent and the real ones are pointed at /dev/null so plugins (or processes
+# they start) can't write into the replies. Output past the limit is thrown away
+# as it is written, like plugin_output_max for other plugins.
+WORKER = r'''
+import io, json, os, runpy, sys, traceback
+class Output(io.StringIO):
+    def __init__(self, limit):
+        io.StringIO.__init__(self)
+        self.limit = limit
+        self.truncated = False
+    def write(self, text):
+        if self.limit and self.tell() + len(text) > self.limit:
+            self.truncated = True
+            io.StringIO.write(self, text[:max(0, self.limit - self.tell())])
+        else:
+            io.StringIO.write(self, text)
+        return len(text)
+    def result(self):
+        data = self.getvalue().encode("utf-8", "replace")
+        if self.limit and len(data) > self.limit:
+            self.truncated = True
+            data = data[:self.limit]
+        return data.decode("utf-8", "ignore")
+requests = os.fdopen(os.dup(0), "r")
+replies = os.fdopen(os.dup(1), "w")
+devnull = os.open(os.devnull, os.O_RDWR)
+os.dup2(devnull, 0)
+os.dup2(devnull, 1)
+for line in requests:
+    request = json.loads(line)
+    argv = request["argv"]
+    output = Output(request["limit"])
+    errors = output if request["stderr"] == "merge" else Output(request["limit"])
+    sys.stdout, sys.stderr = output, errors
+    sys.argv = argv
+    sys.path.insert(0, os.path.dirname(os.path.abspath(argv[0])))
+    returncode = 0
+    try:
+        runpy.run_path(argv[0], run_name="__main__")
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            returncode = e.code
+        elif e.code is not None:
+            output.write(str(e.code) + "\n")
+            returncode = 1
+    except BaseException:
+        traceback.print_exc(file=output)
+        returncode = 1
+    finally:
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        del sys.path[0]
+    reply = {"stdout": output.result(), "stderr": None, "returncode": returncode}
+    if request["stderr"] == "separate":
+        reply["stderr"] = errors.result()
+    reply["truncated"] = output.truncated or errors.truncated
+    replies.write(json.dumps(reply) + "\n")
+    replies.flush()
+'''
+
+
+class WorkerError(Exception):
+    pass
+
+
+class PythonWorker(object):
+    def __init__(self, interpreter):
+        options = {}
+        if environment.SYSTEM != "Windows":
+            options["preexec_fn"] = os.setsid
+        self.process = subprocess.Popen(
+            list(interpreter) + ["-c", WORKER],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            **options
+        )
+        self.runs = 0
+
+    # Run a plugin, raises gevent.Timeout if it takes longer than timeout seconds
+    # and WorkerError if the worker died
+    def run(self, argv, timeout, limit=0, stderr="merge"):
+        self.runs += 1
+        request = {"argv": argv, "limit": limit, "stderr": stderr}
+        try:
+            self.process.stdin.write((json.dumps(request) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+            with gevent.Timeout(timeout):
+                line = self.process.stdout.readline()
+        except (OSError, ValueError) as exc:
+            raise WorkerError(str(exc))
+
+        if not line:
+            raise WorkerError("worker exited with code %s" % self.process.wait())
+        try:
+            reply = json.loads(line.decode("utf-8"))
+            return dict((x, reply[x]) for x in ("stdout", "stderr", "returncode", "truncated"))
+        except (ValueError, KeyError, TypeError) as exc:
+            raise WorkerError("invalid reply from worker: %r" % exc)
+
+    def kill(self):
+        try:
+            if environment.SYSTEM == "Windows":
+                self.process.kill()
+            else:
+                os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+
+
+# The workers for one interpreter command (i.e. python3), all of them are started
+# right away so the first checks don't have to wait for them
+class PythonWorkerPool(object):
+    def __init__(self, interpreter, size):
+        self.interpreter = interpreter
+        self.size = size
+        self.semaphore = gevent.lock.Semaphore(size)
+        self.idle = [PythonWorker(interpreter) for _ in range(size)]
+
+    # Run a plugin in an idle worker, returns the output, stderr (when kept
+    # separate), exit code, if it had to be killed because it timed out and if
+    # the output was truncated
+    def run(self, argv, timeout, limit=0, stderr="merge"):
+        with self.semaphore:
+            worker = self.idle.pop() if self.idle else PythonWorker(self.interpreter)
+            try:
+                reply = worker.run(argv, timeout, limit, stderr)
+            except gevent.Timeout:
+                worker.kill()
+                return "", None, -1, True, False
+            except WorkerError as exc:
+                worker.kill()
+                logging.error("Python worker running %s died: %s", argv[0], exc)
+                return "UNKNOWN: Python worker running the plugin died (%s)" % exc, None, 3, False, False
+
+            if worker.runs < MAX_RUNS:
+                self.idle.append(worker)
+            else:
+                worker.kill()
+            return reply["stdout"], reply["stderr"], reply["returncode"], False, reply["truncated"]
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().kill()
+
+
+pools = {}
+markers = {}
+
+
+def get_size():
+    try:
+        return max(0, int(server.get_config_value("plugin directives", "python_workers", 0)))
+    except (TypeError, ValueError):
+        return 0
+
+
+# Check if a plugin has the worker marker in its first lines, the result is kept
+# until the plugin is modified
+def supports_workers(path):
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return False
+
+    cached = markers.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        with open(path, "rb") as f:
+            supported = MARKER in f.read(2048)
+    except (IOError, OSError):
+        supported = False
+    markers[path] = (mtime, supported)
+    return supported
+
+
+# Get the interpreter command and plugin arguments to use a worker for a plugin
+# command line, or None if workers are off or the plugin doesn't support them
+def get_worker_command(cmd, plugin_path):
+    if not get_size() or not plugin_path.endswith(".py") or plugin_path not in cmd:
+        return None
+    index = cmd.index(plugin_path)
+    if index == 0 or cmd[0] == "sudo" or not supports_workers(plugin_path):
+        return None
+    return tuple(cmd[:index]), cmd[index:]
+
+
+def run(interpreter, argv, timeout, limit=0, stderr="merge"):
+    size = get_size()
+    pool = pools.get(interpreter)
+    if pool is None or pool.size != size:
+        if pool is not None:
+            pool.close()
+        pool = pools[interpreter] = PythonWorkerPool(interpreter, size)
+    return pool.run(argv, timeout, limit, stderr)
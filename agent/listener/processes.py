@@ -1,13 +1,55 @@
+import os
+import heapq
+import gevent
+import gevent.event
 import psutil
 import listener.nodes as nodes
+import listener.server
+import listener.database as database
 import re
 import platform
 import tempfile
+import time
 import subprocess
 from ncpa import listener_logger as logging
 
+if os.name == "posix":
+    import pwd
+
 
 class ProcessNode(nodes.LazyNode):
+
+    # The fields returned for each process and the psutil attribute they are read from
+    process_fields = {
+        "username": "username",
+        "mem_percent": "memory_info",
+        "exe": "exe",
+        "name": "name",
+        "cpu_percent": "cpu_percent",
+        "mem_vms": "memory_info",
+        "cmd": "cmdline",
+        "pid": "pid",
+        "mem_rss": "memory_info",
+    }
+
+    # On Unix the username is looked up from the uid once per scan instead of for
+    # every process (which can be slow with LDAP or other remote user databases)
+    if os.name == "posix":
+        process_fields["username"] = "uids"
+
+    # Filters are checked in this order so cheap attributes can reject a process
+    # first, the prefilter ones can be checked before anything else is read
+    filter_order = ["name", "username", "cpu_percent", "exe", "cmd", "mem_percent", "mem_rss", "mem_vms"]
+    prefilter_fields = ["name", "username", "cpu_percent"]
+
+    # Fields processes can be grouped by and the metrics added up for each group
+    group_fields = ["name", "username", "exe"]
+    group_metrics = ["cpu_percent", "mem_percent", "mem_rss", "mem_vms"]
+    group_stats = ["sum", "avg", "max", "count"]
+
+    # Fields needed to build the long output of a process check
+    check_fields = ["pid", "name", "username", "mem_percent", "cpu_percent", "mem_vms", "mem_rss"]
+
     @staticmethod
     def get_exe(request_args):
         exe = request_args.get("exe", [])
@@ -97,6 +139,79 @@ class ProcessNode(nodes.LazyNode):
                     short_output = False
         return short_output
 
+    @staticmethod
+    def get_fresh(request_args):
+        fresh = request_args.get("fresh", False)
+        if isinstance(fresh, list):
+            fresh = fresh[0]
+        return str(fresh).strip().lower() in ('yes', 'true', 't', 'on', '1')
+
+    @staticmethod
+    def get_fields(request_args):
+        fields = request_args.get("fields", [])
+        if not isinstance(fields, list):
+            fields = [fields]
+        fields = [x.strip() for field in fields for x in field.split(",")]
+        return [x for x in fields if x in ProcessNode.process_fields]
+
+    @staticmethod
+    def get_sort(request_args):
+        sort = request_args.get("sort", None)
+        if isinstance(sort, list):
+            sort = sort[0]
+        if sort in ProcessNode.process_fields:
+            return sort
+        return None
+
+    # Numbers are sorted largest first and strings alphabetically by default
+    @staticmethod
+    def get_order(request_args, sort):
+        order = request_args.get("order", None)
+        if isinstance(order, list):
+            order = order[0]
+        if order in ("asc", "desc"):
+            return order
+        if sort in ("pid", "name", "exe", "username", "cmd"):
+            return "asc"
+        return "desc"
+
+    @staticmethod
+    def get_limit(request_args, name="limit"):
+        limit = request_args.get(name, None)
+        if isinstance(limit, list):
+            limit = limit[0]
+        try:
+            return max(0, int(limit))
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def get_group_by(request_args):
+        group_by = request_args.get("group_by", None)
+        if isinstance(group_by, list):
+            group_by = group_by[0]
+        if group_by in ProcessNode.group_fields:
+            return group_by
+        return None
+
+    @staticmethod
+    def get_group_metric(request_args):
+        metric = request_args.get("group_metric", "cpu_percent")
+        if isinstance(metric, list):
+            metric = metric[0]
+        if metric in ProcessNode.group_metrics:
+            return metric
+        return "cpu_percent"
+
+    @staticmethod
+    def get_group_stat(request_args):
+        stat = request_args.get("group_stat", "sum")
+        if isinstance(stat, list):
+            stat = stat[0]
+        if stat in ProcessNode.group_stats:
+            return stat
+        return "sum"
+
     @staticmethod
     def get_combiner(request_args):
         combiner = request_args.get("combiner", "and")
@@ -115,191 +230,263 @@ class ProcessNode(nodes.LazyNode):
                 match = match[0]
         return match
 
-    def make_filter(self, *args, **kwargs):
-        exes = self.get_exe(kwargs)
-        usernames = self.get_username(kwargs)
-        names = self.get_name(kwargs)
-        cmds = self.get_cmd(kwargs)
-        cpu_percent = self.get_cpu_percent(kwargs)
-        mem_percent = self.get_mem_percent(kwargs)
+    # Get the {field: values} exact match filters that can be looked up in the
+    # process index, only when every filter has to match
+    def get_index_filters(self, request_args):
+        if self.get_combiner(request_args) != all or self.get_match(request_args) in ("search", "regex"):
+            return None
+        filters = {}
+        for field in ProcessIndex.fields:
+            values = getattr(self, "get_" + field)(request_args)
+            if values:
+                filters[field] = values
+        return filters or None
+
+    # Fields the filters in the request need to look at
+    @staticmethod
+    def get_filter_fields(request_args):
+        fields = []
+        for field in ProcessNode.filter_order:
+            if request_args.get(field, None):
+                fields.append(field)
+        return fields
+
+    # Make a test for a string field that is compiled once for the request, the
+    # needles of the same field are combined the same way all filters are
+    @staticmethod
+    def make_string_test(field, needles, match, comparison):
+        if match == "regex":
+            try:
+                patterns = [re.compile(x) for x in needles]
+            except re.error as exc:
+                logging.warning("Invalid %s regex in process filter: %s", field, exc)
+                return lambda value: False
+
+            def test(value):
+                return comparison(pattern.search(value) is not None for pattern in patterns)
+        else:
+            needles = [x.lower() for x in needles]
+            if match == "search":
+                def test(value):
+                    value = value.lower()
+                    return comparison(needle in value for needle in needles)
+            else:
+                def test(value):
+                    value = value.lower()
+                    return comparison(value == needle for needle in needles)
+
+        # Processes without a command line never match a cmd filter
+        if field == "cmd":
+            return lambda value: bool(value) and test(value)
+        return test
+
+    # Get the (field, test) filters for the request in the order they are checked
+    def make_filter_tests(self, request_args, comparison):
+        match = self.get_match(request_args)
+        strings = {
+            "name": self.get_name(request_args),
+            "username": self.get_username(request_args),
+            "exe": self.get_exe(request_args),
+            "cmd": self.get_cmd(request_args),
+        }
+        minimums = {
+            "cpu_percent": self.get_cpu_percent(request_args),
+            "mem_percent": self.get_mem_percent(request_args),
+            "mem_rss": self.get_mem_rss(request_args),
+            "mem_vms": self.get_mem_vms(request_args),
+        }
+
+        tests = []
+        for field in self.filter_order:
+            if strings.get(field):
+                tests.append((field, self.make_string_test(field, strings[field], match, comparison)))
+            elif minimums.get(field) is not None:
+                tests.append((field, lambda value, minimum=minimums[field]: minimum <= value[0]))
+        return tests
+
+    def make_filter(self, *args, filter_fields=None, **kwargs):
         comparison = self.get_combiner(kwargs)
-        mem_rss = self.get_mem_rss(kwargs)
-        mem_vms = self.get_mem_vms(kwargs)
-        match = self.get_match(kwargs)
-        short_output = self.get_short_output(kwargs)
+        tests = self.make_filter_tests(kwargs, comparison)
+        if filter_fields is not None:
+            tests = [x for x in tests if x[0] in filter_fields]
 
+        # Filters are checked in order and stop at the first test that decides it
         def proc_filter(process):
-            comp = []
-
-            for exe in exes:
-                if match == "search":
-                    if exe.lower() in process["exe"].lower():
-                        comp.append(True)
-                    else:
-                        comp.append(False)
-                elif match == "regex":
-                    if re.search(exe, process["exe"]):
-                        comp.append(True)
-                    else:
-                        comp.append(False)
-                else:
-                    if process["exe"].lower() == exe.lower():
-                        comp.append(True)
-                    else:
-                        comp.append(False)
-
-            for username in usernames:
-                if match == "search":
-                    if username.lower() in process["username"].lower():
-                        comp.append(True)
-                    else:
-                        comp.append(False)
-                elif match == "regex":
-                    if re.search(username, process["username"]):
-                        comp.append(True)
-                    else:
-                        comp.append(False)
-                else:
-                    if process["username"].lower() == username.lower():
-                        comp.append(True)
-                    else:
-                        comp.append(False)
-
-            for name in names:
-                if match == "search":
-                    if name.lower() in process["name"].lower():
-                        comp.append(True)
-                    else:
-                        comp.append(False)
-                elif match == "regex":
-                    if re.search(name, process["name"]):
-                        comp.append(True)
-                    else:
-                        comp.append(False)
-                else:
-                    if process["name"].lower() == name.lower():
-                        comp.append(True)
-                    else:
-                        comp.append(False)
-
-            for cmd in cmds:
-                process_cmd = process["cmd"].lower()
-                if not process_cmd:
-                    comp.append(False)
-                else:
-                    if match == "search":
-                        if cmd.lower() in process["cmd"].lower():
-                            comp.append(True)
-                        else:
-                            comp.append(False)
-                    elif match == "regex":
-                        if re.search(cmd, process["cmd"]):
-                            comp.append(True)
-                        else:
-                            comp.append(False)
-                    else:
-                        if process["cmd"].lower() == cmd.lower():
-                            comp.append(True)
-                        else:
-                            comp.append(False)
-
-            if not cpu_percent is None:
-                comp.append(cpu_percent <= process["cpu_percent"][0])
-
-            if not mem_percent is None:
-                comp.append(mem_percent <= process["mem_percent"][0])
-
-            if not mem_rss is None:
-                comp.append(mem_rss <= process["mem_rss"][0])
-
-            if not mem_vms is None:
-                comp.append(mem_vms <= process["mem_vms"][0])
-
-            return comparison(comp)
+            return comparison(test(process[field]) for field, test in tests)
 
         return proc_filter
 
-    @staticmethod
-    def standard_form(self, process, ps_procs, units="", sleep=None):
-        pid = str(process.pid)
+    # Read the process data in one pass with only the fields that are needed, the
+    # psutil attributes are all fetched at once (using oneshot) by process_iter
+    def standard_form(self, info, ps_procs, fields, units="", cpu_count=1, total_memory=0, usernames=None):
+        pid = info["pid"]
+        proc = ps_procs.get(str(pid))
+        process = {"pid": pid}
+
+        if "cmd" in fields:
+            if proc is not None and len(proc) > 2:
+                process["cmd"] = proc[2]
+            elif info.get("cmdline") is not None:
+                process["cmd"] = " ".join(info["cmdline"])
+            else:
+                process["cmd"] = "Unknown"
 
-        try:
-            if pid in ps_procs:
-                proc = ps_procs.get(pid)
-                cmd = proc[2]
+        for field in ("name", "exe"):
+            if field in fields:
+                value = info.get(field)
+                process[field] = "Unknown" if value is None else value
+
+        if "username" in fields:
+            if "uids" in info:
+                process["username"] = self.get_uid_username(info["uids"], usernames)
             else:
-                cmd = " ".join(process.cmdline())
-        except BaseException:
-            cmd = "Unknown"
+                process["username"] = info.get("username") or "Unknown"
 
-        try:
-            name = process.name()
-        except BaseException:
-            name = "Unknown"
+        if "cpu_percent" in fields:
+            try:
+                if proc is not None:
+                    cpu_percent = round(float(proc[0]), 2)
+                else:
+                    cpu_percent = round(info["cpu_percent"] / cpu_count, 2)
+            except (TypeError, ValueError):
+                cpu_percent = 0
+            process["cpu_percent"] = (cpu_percent, "%")
 
-        try:
-            exe = process.exe()
-        except BaseException:
-            exe = "Unknown"
+        pmi = info.get("memory_info")
+        if "mem_percent" in fields:
+            try:
+                if proc is not None:
+                    mem_percent = round(float(proc[1]), 2)
+                else:
+                    mem_percent = round(pmi.rss / total_memory * 100, 2)
+            except (AttributeError, TypeError, ValueError, ZeroDivisionError):
+                mem_percent = 0
+            process["mem_percent"] = (mem_percent, "%")
 
-        try:
-            username = process.username()
-        except BaseException:
-            username = "Unknown"
+        if "mem_rss" in fields or "mem_vms" in fields:
+            try:
+                # Make unit types
+                u = "B"
+                if units != "B":
+                    u = "%s%s" % (units, "B")
+
+                # Get adjusted scales
+                value, uts = self.adjust_scale(self, pmi.rss, units)
+                mem_rss = (value, u)
+                value, uts = self.adjust_scale(self, pmi.vms, units)
+                mem_vms = (value, u)
+            except Exception as exc:
+                # logging.exception(exc)
+                mem_rss, mem_vms = (0, "B"), (0, "B")
+
+            if "mem_rss" in fields:
+                process["mem_rss"] = mem_rss
+            if "mem_vms" in fields:
+                process["mem_vms"] = mem_vms
+
+        return process
 
-        try:
-            # Check if process pid is in ps_procs
-            if pid in ps_procs:
-                proc = ps_procs.get(pid)
-                cpu_percent = round(float(proc[0]), 2)
-            else:
-                cpu_percent = round(process.cpu_percent(sleep) / psutil.cpu_count(), 2)
-        except BaseException:
-            cpu_percent = 0
+    @staticmethod
+    def get_uid_username(uids, usernames):
+        if uids is None:
+            return "Unknown"
+        if uids.real not in usernames:
+            try:
+                usernames[uids.real] = pwd.getpwuid(uids.real).pw_name
+            except KeyError:
+                usernames[uids.real] = str(uids.real)
+        return usernames[uids.real]
 
-        try:
-            # Check if process pid is in ps_procs
-            if pid in ps_procs:
-                proc = ps_procs.get(pid)
-                mem_percent = round(float(proc[1]), 2)
-            else:
-                mem_percent = round(process.memory_percent(), 2)
-        except BaseException:
-            mem_percent = 0
+    # Start measuring CPU usage for all processes, process_iter() keeps the same
+    # Process objects between calls so the next cpu_percent() is since this one
+    @staticmethod
+    def prime_cpu_percent():
+        for process in psutil.process_iter():
+            try:
+                process.cpu_percent(None)
+            except psutil.Error:
+                continue
 
-        try:
-            # Make unit types
-            u = "B"
-            if units != "B":
-                u = "%s%s" % (units, "B")
-
-            # Get adjusted scales
-            pmi = process.memory_info()
-            value, uts = self.adjust_scale(self, pmi.rss, units)
-            mem_rss = (value, u)
-            value, uts = self.adjust_scale(self, pmi.vms, units)
-            mem_vms = (value, u)
-        except Exception as exc:
-            # logging.exception(exc)
-            mem_rss, mem_vms = (0, "B"), (0, "B")
-
-        return {
-            "username": username,
-            "mem_percent": (mem_percent, "%"),
-            "exe": exe,
-            "name": name,
-            "cpu_percent": (cpu_percent, "%"),
-            "mem_vms": mem_vms,
-            "cmd": cmd,
-            "pid": int(pid),
-            "mem_rss": mem_rss,
-        }
+    # When all filters must match, filters on cheap attributes are checked while
+    # scanning so the other attributes are only read for processes that pass
+    def make_prefilter(self, ps_procs, read_fields, **kwargs):
+        units = kwargs.get("units", ["B"])[0]
+        prefilter_fields = [x for x in self.get_filter_fields(kwargs) if x in self.prefilter_fields]
+        if self.get_combiner(kwargs) != all or not prefilter_fields or read_fields.issubset(self.prefilter_fields):
+            return None, None
+
+        prefilter_test = self.make_filter(filter_fields=prefilter_fields, **kwargs)
+
+        def prefilter(info, snapshot):
+            process = self.standard_form(info, ps_procs, prefilter_fields, units, snapshot.cpu_count,
+                                         snapshot.total_memory, snapshot.usernames)
+            return prefilter_test(process)
+
+        return prefilter, set(self.process_fields[x] for x in prefilter_fields)
+
+    def get_process_dict(self, *args, output_fields=None, **kwargs):
+        return list(self.iter_processes(output_fields=output_fields, *args, **kwargs))
 
-    def get_process_dict(self, *args, **kwargs):
+    # Generate the processes that match the filters in the request
+    def iter_processes(self, *args, output_fields=None, **kwargs):
         units = kwargs.get("units", ["B"])
         sleep = self.get_sleep(kwargs)
         proc_filter = self.make_filter(*args, **kwargs)
-        processes = []
+
+        # Only read the process attributes needed for the output and filters
+        if output_fields is None:
+            output_fields = self.process_fields
+        fields = set(output_fields) | set(self.get_filter_fields(kwargs))
+        attrs = set(["pid"] + [self.process_fields[x] for x in fields if x in self.process_fields])
+        ps_procs = self.get_ps_procs()
+
+        # Use the shared process table snapshot if it's recent enough, unless the
+        # request wants fresh data or CPU usage over a sleep interval
+        snapshot = None
+        if not sleep and not self.get_fresh(kwargs):
+            snapshot = sampler.get_snapshot()
+
+            # Exact name and exe filters only need to read the indexed processes
+            if snapshot is None:
+                snapshot = index.get_snapshot(attrs, self.get_index_filters(kwargs))
+
+        if snapshot is None:
+
+            # CPU usage over a sleep interval is measured by priming every process,
+            # waiting once and then reading the usage since the priming in the scan
+            if sleep and "cpu_percent" in attrs:
+                self.prime_cpu_percent()
+                time.sleep(sleep)
+
+            snapshot = ProcessSnapshot(attrs, *self.make_prefilter(ps_procs, fields, **kwargs))
+            if snapshot.is_complete():
+                sampler.set_snapshot(snapshot)
+
+        for proc_obj in self.iter_snapshot(snapshot, fields, proc_filter, ps_procs, units[0]):
+            yield proc_obj
+
+    # Generate the processes in a snapshot (that match the filter) with the given
+    # fields, i.e. to build output from a snapshot the sampler took
+    def iter_snapshot(self, snapshot, fields, proc_filter=None, ps_procs=None, units="B"):
+        if ps_procs is None:
+            ps_procs = self.get_ps_procs()
+
+        # Do actual process looping
+        for info in snapshot.infos:
+            try:
+                proc_obj = self.standard_form(info, ps_procs, fields, units, snapshot.cpu_count,
+                                              snapshot.total_memory, snapshot.usernames)
+                if proc_filter is not None and not proc_filter(proc_obj):
+                    continue
+            except Exception as e:
+                # Could not access process, most likely because of windows permissions
+                logging.exception(e)
+                continue
+            yield proc_obj
+
+    # Read the CPU and memory usage (and command lines on AIX) from ps on the systems
+    # where psutil doesn't have them
+    def get_ps_procs(self):
         ps_procs = {}
 
         # Mac OS X requires using ps command to get cpu/memory data (as nagios)
@@ -338,23 +525,84 @@ class ProcessNode(nodes.LazyNode):
                 cols = line.split()
                 ps_procs[cols[1]] = [cols[2], cols[3], " ".join(cols[10:])]
 
-        # Do actual process looping
-        for process in psutil.process_iter():
-            try:
-                proc_obj = self.standard_form(self, process, ps_procs, units[0], sleep)
-                if proc_filter(proc_obj):
-                    processes.append(proc_obj)
-            except Exception as e:
-                # Could not access process, most likely because of windows permissions
-                logging.exception(e)
-                continue
+        return ps_procs
+
+    # Add up the metrics of the matching processes for each group while scanning,
+    # the process list itself is never kept
+    def get_process_groups(self, *args, **kwargs):
+        group_by = self.get_group_by(kwargs)
+        groups = {}
+
+        for process in self.iter_processes(output_fields=[group_by] + self.group_metrics, *args, **kwargs):
+            group = groups.get(process[group_by])
+            if group is None:
+                group = groups[process[group_by]] = {"count": 0, "sum": {}, "max": {}, "unit": {}}
+            group["count"] += 1
+            for metric in self.group_metrics:
+                value, unit = process[metric]
+                group["sum"][metric] = group["sum"].get(metric, 0) + value
+                group["max"][metric] = max(group["max"].get(metric, value), value)
+                group["unit"][metric] = unit
+
+        results = {}
+        for key, group in groups.items():
+            results[key] = {"count": group["count"]}
+            for metric in self.group_metrics:
+                unit = group["unit"][metric]
+                results[key][metric] = {
+                    "sum": [round(group["sum"][metric], 2), unit],
+                    "avg": [round(group["sum"][metric] / group["count"], 2), unit],
+                    "max": [group["max"][metric], unit],
+                }
+        return results
 
-        return processes
+    @staticmethod
+    def get_sort_key(field):
+        def sort_key(process):
+            value = process[field]
+            if isinstance(value, tuple):
+                return value[0]
+            if isinstance(value, str):
+                return value.lower()
+            return value
+        return sort_key
+
+    # Sort and page the process list, when there is a limit only the processes on
+    # the requested page are selected (partial sort) instead of sorting them all
+    def sort_processes(self, processes, request_args):
+        sort = self.get_sort(request_args)
+        limit = self.get_limit(request_args)
+        offset = self.get_limit(request_args, "offset") or 0
+
+        if sort is not None:
+            key = self.get_sort_key(sort)
+            reverse = self.get_order(request_args, sort) == "desc"
+            if limit is not None:
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                processes = select(offset + limit, processes, key=key)
+            else:
+                processes = sorted(processes, key=key, reverse=reverse)
+
+        if limit is not None:
+            return processes[offset:offset + limit]
+        return processes[offset:]
 
     def walk(self, *args, **kwargs):
         self.method = self.get_process_dict
         if kwargs.get("first", True):
-            return {self.name: self.method(*args, **kwargs)}
+            if self.get_group_by(kwargs):
+                return {self.name: self.get_process_groups(*args, **kwargs)}
+
+            # Only collect the requested fields (and the one to sort on)
+            fields = self.get_fields(kwargs)
+            output_fields = None
+            if fields:
+                output_fields = fields + [x for x in [self.get_sort(kwargs)] if x]
+
+            processes = self.sort_processes(self.method(output_fields=output_fields, *args, **kwargs), kwargs)
+            if fields:
+                processes = [dict((x, process[x]) for x in fields if x in process) for process in processes]
+            return {self.name: processes}
         else:
             return {self.name: []}
 
@@ -391,9 +639,129 @@ class ProcessNode(nodes.LazyNode):
                 title += " Memory Usage greater than %.2f %s" % (mem_percent, "%")
         return [title]
 
+    # Check a metric of each process group against the thresholds, the check is
+    # as bad as the worst group and every group gets its own perfdata
+    def run_group_check(self, *args, **kwargs):
+        group_by = self.get_group_by(kwargs)
+        metric = self.get_group_metric(kwargs)
+        stat = self.get_group_stat(kwargs)
+        groups = self.get_process_groups(*args, **kwargs)
+
+        self.set_warning(kwargs)
+        self.set_critical(kwargs)
+        warning = "".join(self.warning)
+        critical = "".join(self.critical)
+
+        returncode = 0
+        results = []
+        perfdata = []
+        try:
+            for key in sorted(groups):
+                if stat == "count":
+                    value, unit = groups[key]["count"], ""
+                else:
+                    value, unit = groups[key][metric][stat]
+
+                if self.is_within_range(critical, value):
+                    returncode = 2
+                elif self.is_within_range(warning, value) and returncode < 2:
+                    returncode = 1
+
+                results.append("%s %s %s" % (key, value, unit))
+                perf_unit = unit if len(unit) <= 3 else ""
+                perfdata.append("'%s'=%s%s;%s;%s;" % (key.replace("'", '"').replace("=", "_"), value, perf_unit, warning, critical))
+        except Exception as exc:
+            returncode = 3
+            results = [str(exc)]
+            perfdata = []
+            logging.exception(exc)
+
+        if stat == "count":
+            title = "Process count by %s" % group_by
+        else:
+            title = "%s %s of processes by %s" % (stat.capitalize(), metric, group_by)
+
+        prefix = ["OK", "WARNING", "CRITICAL", "UNKNOWN"][returncode]
+        if results:
+            stdout = "%s: %s was %s" % (prefix, title, ", ".join(x.strip() for x in results))
+        else:
+            stdout = "%s: %s found no processes" % (prefix, title)
+        if perfdata:
+            stdout += " | " + " ".join(perfdata)
+
+        # Get the check logging value
+        try:
+            check_logging = int(kwargs["config"].get("general", "check_logging"))
+        except Exception as e:
+            check_logging = 1
+
+        # Send check results to database
+        if not listener.server.__INTERNAL__ and check_logging == 1:
+            db = database.DB()
+            current_time = time.time()
+            db.add_check(
+                kwargs["accessor"].rstrip("/"),
+                current_time,
+                current_time,
+                returncode,
+                stdout,
+                kwargs["remote_addr"],
+                "Active",
+            )
+
+        return {"returncode": returncode, "stdout": stdout}
+
+    @staticmethod
+    def get_output_limit(option, default):
+        try:
+            return max(0, int(listener.server.get_config_value("listener", option, default)))
+        except (TypeError, ValueError):
+            return default
+
+    # Make the long output lines for the matched processes (the heaviest first when
+    # sorted), stopping at process_output_lines lines or process_output_bytes bytes
+    def make_process_lines(self, processes, request_args):
+        max_lines = self.get_output_limit("process_output_lines", 100)
+        max_bytes = self.get_output_limit("process_output_bytes", 16384)
+
+        sort_args = {"sort": request_args.get("sort"), "order": request_args.get("order")}
+        if max_lines:
+            sort_args["limit"] = [max_lines]
+        listed = self.sort_processes(processes, sort_args)
+
+        lines = []
+        size = 0
+        for proc in listed:
+            line = "%s: %s: %s: %s %s (VMS %.2f %s, RSS %.2f %s): %.2f %s\n" % (
+                proc["pid"],
+                proc["name"],
+                proc["username"],
+                proc["mem_percent"][0],
+                "%",
+                proc["mem_vms"][0],
+                proc["mem_vms"][1],
+                proc["mem_rss"][0],
+                proc["mem_rss"][1],
+                proc["cpu_percent"][0],
+                "%",
+            )
+            size += len(line.encode("utf-8"))
+            if max_bytes and size > max_bytes:
+                break
+            lines.append(line)
+
+        if len(lines) < len(processes):
+            lines.append("... and %d more processes\n" % (len(processes) - len(lines)))
+        return "".join(lines)
+
     def run_check(self, *args, **kwargs):
-        procs = self.walk(first=True, *args, **kwargs)
+        if self.get_group_by(kwargs):
+            return self.run_group_check(*args, **kwargs)
+
         short_output = self.get_short_output(kwargs)
+        sort = self.get_sort(kwargs)
+        output_fields = self.check_fields + [sort] if sort else self.check_fields
+        procs = {self.name: self.get_process_dict(output_fields=output_fields, *args, **kwargs)}
 
         def process_check_method():
             count = len(procs["processes"])
@@ -424,32 +792,17 @@ class ProcessNode(nodes.LazyNode):
             else:
                 extra = "\nProcesses Matched\nPID: Name: Username: Exe: Memory: CPU\n-----------------------------------\n"
 
-            # Loop through each process to calculate totals and add to output
+            # Loop through each process to calculate totals
             for proc in procs["processes"]:
                 tmem += proc["mem_percent"][0]
                 tcpu += proc["cpu_percent"][0]
                 tmem_vms += proc["mem_vms"][0]
                 tmem_rss += proc["mem_rss"][0]
                 mem_unit = proc["mem_vms"][1]
-                memory = "%s %s (VMS %.2f %s, RSS %.2f %s)" % (
-                    proc["mem_percent"][0],
-                    "%",
-                    proc["mem_vms"][0],
-                    proc["mem_vms"][1],
-                    proc["mem_rss"][0],
-                    proc["mem_rss"][1],
-                )
-
-                # Add individual process info to output
-                if not short_output:
-                    extra += "%s: %s: %s: %s: %.2f %s\n" % (
-                        proc["pid"],
-                        proc["name"],
-                        proc["username"],
-                        memory,
-                        proc["cpu_percent"][0],
-                        "%",
-                    )
+
+            # Add individual process info to output
+            if not short_output:
+                extra += self.make_process_lines(procs["processes"], kwargs)
 
             # Add totals to the output
             extra += "\nTotal Memory: %.2f %s (VMS %.2f %s, RSS %.2f %s)\n" % (
@@ -480,6 +833,210 @@ class ProcessNode(nodes.LazyNode):
         return check_return
 
 
+# The process table read in a single pass, only the psutil attributes given are
+# read for each process
+class ProcessSnapshot(object):
+    def __init__(self, attrs=None, prefilter=None, prefilter_attrs=None, processes=None):
+        if attrs is None:
+            attrs = ProcessNode.process_fields.values()
+        self.attrs = set(attrs) | set(["pid"])
+        self.filtered = prefilter is not None or processes is not None
+        self.cpu_count = psutil.cpu_count() or 1
+        self.total_memory = psutil.virtual_memory().total
+        self.usernames = {}
+        self.infos = self.read_infos(prefilter, prefilter_attrs, processes)
+
+        # The time is taken when the scan is done so a snapshot from a slow scan
+        # isn't already out of date when it is shared
+        self.time = time.time()
+
+    def read_infos(self, prefilter, prefilter_attrs, processes):
+
+        # Only read the given processes (found in the process index)
+        if processes is not None:
+            infos = []
+            for process in processes:
+                try:
+                    infos.append(process.as_dict(list(self.attrs), ad_value=None))
+                except psutil.NoSuchProcess:
+                    continue
+            return infos
+
+        if not self.filtered:
+            return [p.info for p in psutil.process_iter(attrs=list(self.attrs), ad_value=None)]
+
+        # Read the attributes the prefilter needs first and the rest only for the
+        # processes it keeps
+        infos = []
+        rest = list(self.attrs - prefilter_attrs)
+        for process in psutil.process_iter(attrs=list(prefilter_attrs | set(["pid"])), ad_value=None):
+            if not prefilter(process.info, self):
+                continue
+            try:
+                process.info.update(process.as_dict(rest, ad_value=None))
+            except psutil.NoSuchProcess:
+                continue
+            infos.append(process.info)
+        return infos
+
+    # Only unfiltered snapshots with every attribute can be shared with other requests
+    def is_complete(self):
+        return not self.filtered and self.attrs.issuperset(ProcessNode.process_fields.values())
+
+
+# Keeps one shared process table snapshot which is refreshed in the background
+# every process_sample_interval seconds while something (the top websocket) is
+# subscribed, API requests use the snapshot while it's not older than that
+class ProcessSampler(object):
+    def __init__(self):
+        self.snapshot = None
+        self.subscribers = 0
+        self.greenlet = None
+        self.updated = gevent.event.Event()
+
+    def get_interval(self):
+        try:
+            interval = listener.server.get_config_value("listener", "process_sample_interval", 1)
+            return max(0.1, float(interval))
+        except (TypeError, ValueError):
+            return 1.0
+
+    def get_snapshot(self):
+        snapshot = self.snapshot
+        if snapshot is not None and time.time() - snapshot.time <= self.get_interval():
+            return snapshot
+        return None
+
+    # Save a new snapshot and wake up everything waiting for it
+    def set_snapshot(self, snapshot):
+        self.snapshot = snapshot
+        updated, self.updated = self.updated, gevent.event.Event()
+        updated.set()
+
+    # Wait for the next snapshot, returns None if there wasn't one before the timeout
+    def wait(self, timeout=None):
+        if timeout is None:
+            timeout = self.get_interval() * 5
+        if self.updated.wait(timeout):
+            return self.snapshot
+        return None
+
+    def subscribe(self):
+        self.subscribers += 1
+        if self.greenlet is None or self.greenlet.dead:
+            self.greenlet = gevent.spawn(self.run)
+
+    def unsubscribe(self):
+        self.subscribers = max(0, self.subscribers - 1)
+
+    def run(self):
+        while self.subscribers > 0:
+            start = time.time()
+            try:
+                self.set_snapshot(ProcessSnapshot())
+            except Exception as e:
+                logging.exception(e)
+            gevent.sleep(max(0, self.get_interval() - (time.time() - start)))
+
+
+# Index of the processes by name and exe so checks for a specific process don't
+# have to read the whole process table. The index is updated by a full scan every
+# process_index_interval seconds, a process is only replaced when the scan finds a
+# different create time for its PID (the PID was reused). Between scans a lookup
+# makes sure the indexed processes are still the same ones and does a full scan
+# if any of them are gone, since a restarted process will have a new PID.
+class ProcessIndex(object):
+    fields = ["name", "exe"]
+
+    def __init__(self):
+        self.processes = {}
+        self.index = dict((field, {}) for field in self.fields)
+        self.time = 0
+
+    def get_interval(self):
+        try:
+            interval = listener.server.get_config_value("listener", "process_index_interval", 60)
+            return max(0, float(interval))
+        except (TypeError, ValueError):
+            return 60.0
+
+    def add(self, process, info):
+        self.processes[info["pid"]] = (info["create_time"], process, info)
+        for field in self.fields:
+            if info[field]:
+                self.index[field].setdefault(info[field].lower(), set()).add(info["pid"])
+
+    def remove(self, pid):
+        create_time, process, info = self.processes.pop(pid)
+        for field in self.fields:
+            if info[field]:
+                pids = self.index[field].get(info[field].lower(), set())
+                pids.discard(pid)
+                if not pids:
+                    self.index[field].pop(info[field].lower(), None)
+
+    # Scan the process table and only update the PIDs that are new or reused
+    def update(self):
+        seen = set()
+        for process in psutil.process_iter(attrs=["pid", "create_time"] + self.fields, ad_value=None):
+            info = process.info
+            seen.add(info["pid"])
+            current = self.processes.get(info["pid"])
+            if current is not None and current[0] == info["create_time"]:
+                continue
+            if current is not None:
+                self.remove(info["pid"])
+            self.add(process, info)
+
+        for pid in set(self.processes) - seen:
+            self.remove(pid)
+        self.time = time.time()
+
+    # Get the PIDs matching all the exact filters, a field with more than one value
+    # can only match if they are all the same (like the process filters)
+    def find(self, filters):
+        pids = None
+        for field, values in filters.items():
+            for value in values:
+                matches = self.index[field].get(value.lower(), set())
+                pids = set(matches) if pids is None else pids & matches
+        return pids or set()
+
+    # Get the indexed processes matching the filters, or None if any of them are
+    # gone or their PID was reused (is_running() checks the create time)
+    def get_processes(self, filters):
+        processes = []
+        for pid in self.find(filters):
+            process = self.processes[pid][1]
+            if not process.is_running():
+                return None
+            processes.append(process)
+        return processes
+
+    # Make a snapshot of only the processes matching the filters, returns None if
+    # the index can't be used and the whole process table has to be scanned
+    def get_snapshot(self, attrs, filters):
+        interval = self.get_interval()
+        if not filters or not interval:
+            return None
+
+        if time.time() - self.time > interval:
+            self.update()
+
+        processes = self.get_processes(filters)
+        if processes is None:
+            self.update()
+            processes = self.get_processes(filters)
+            if processes is None:
+                return None
+
+        return ProcessSnapshot(attrs, processes=processes)
+
+
+sampler = ProcessSampler()
+index = ProcessIndex()
+
+
 def get_node():
     logging.debug("get_node() was called for processes")
     return ProcessNode("processes", None)
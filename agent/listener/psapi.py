@@ -658,6 +658,12 @@ def refresh(config, path=None):
     return True
 
 
+# Split the accessor path on / (but not if they are inside " or ')
+def split_accessor(accessor):
+    pattern = re.compile(r"""((?:[^/"']|"[^"]*"|'[^']*')+)""")
+    return pattern.split(accessor)[1::2]
+
+
 def getter(accessor, config, full_path, args, cache=False):
     global root
 
@@ -665,9 +671,7 @@ def getter(accessor, config, full_path, args, cache=False):
     if accessor is None:
         return
 
-    # Split the accessor path on / (but not if they are inside " or ')
-    pattern = re.compile(r"""((?:[^/"']|"[^"]*"|'[^']*')+)""")
-    path = pattern.split(accessor)[1::2]
+    path = split_accessor(accessor)
 
     # Check if this should be a cached query or if we should reset the root
     # node. This normally only happens on new API calls. When we are using
@@ -11,7 +11,10 @@ import json
 import psutil
 import listener.psapi as psapi
 import listener.processes as processes
+import listener.services as services
+import listener.pluginexecutor as pluginexecutor
 import listener.database as database
+import listener.history as history
 import math
 import re
 import ipaddress
@@ -88,6 +91,7 @@ def make_info_dict():
     db = database.DB()
     total_checks = db.get_checks_count()
     check_logging_time = int(get_config_value('general', 'check_logging_time', 30))
+    maintenance = db.get_maintenance_stats()
 
     uname = platform.uname()
     proc_type = uname[5]
@@ -106,7 +110,8 @@ def make_info_dict():
              'release': uname[2],
              'version': uname[3],
              'total_checks': format(total_checks, ",d"),
-             'check_logging_time': check_logging_time }
+             'check_logging_time': check_logging_time,
+             'maintenance': maintenance }
 
 
 def get_unmapped_ip(ip):
@@ -552,7 +557,9 @@ def checks():
     size = int(request.values.get('size', 20))
     page = int(request.values.get('page', 1))
     ctype = request.values.get('ctype', '')
-    page_raw = page
+    before = request.values.get('before', None)
+    after = request.values.get('after', None)
+    oldest = request.values.get('oldest', None) is not None
 
     status = request.values.get('status', '')
     if status != '':
@@ -560,23 +567,41 @@ def checks():
 
     check_senders = request.values.getlist('check_senders')
 
+    # Totals come from the maintained check counts
+    total = db.get_checks_count(search, status=status, senders=check_senders, ctype=ctype)
+
+    total_pages = int(math.ceil(float(total)/size))
+    if total_pages < 1:
+        total_pages = 1
+
+    # The last page only holds what is left over from the full pages
+    last_size = size
+    if oldest:
+        page = total_pages
+        last_size = total - (total_pages - 1) * size
+        if last_size < 1:
+            last_size = size
+    if page < 1:
+        page = 1
+    if page > total_pages:
+        page = total_pages
+    page_raw = page
+
+    # Pages are walked with cursors from the edges of the current page, the page
+    # number is only used to find the page when no cursor was given
+    checks = db.get_checks(search, last_size, page, status=status, ctype=ctype, senders=check_senders,
+                           before=before, after=after, oldest=oldest)
+
     # Add data values for page
     data['check_senders'] = check_senders
     data['search'] = search
-    data['checks'] = db.get_checks(search, size, page, status=status, ctype=ctype, senders=check_senders)
+    data['checks'] = checks
     data['size'] = size
     data['page'] = format(page, ",d")
     data['page_raw'] = page_raw
     data['status'] = status
     data['ctype'] = ctype
 
-    # Do some page math magic
-    total = db.get_checks_count(search, status=status, senders=check_senders)
-
-    total_pages = int(math.ceil(float(total)/size))
-    if total_pages < 1:
-        total_pages = 1
-
     data['total_pages'] = format(total_pages, ",d")
     data['total'] = format(total, ",d")
 
@@ -590,25 +615,22 @@ def checks():
     if ctype != '':
         link_vals += '&ctype=' + str(ctype)
     if search != '':
-        link_vals += '&search=' + str(search)
+        link_vals += '&search=' + urllib.parse.quote(str(search))
     if len(check_senders) > 0:
         for sender in check_senders:
-            link_vals += '&check_senders=' + sender
-
-    # Get list of pages to display
-    data['page_links'] = { page: link + str(page) }
-    for x in range(1, 5):
-        if not (page_raw - x) <= 0:
-            data['page_links'][page_raw - x] = link + str(page - x) + link_vals
-            if page_raw > 5:
-                data['show_fp'] = True
-                data['show_fp_link'] = link + '1' + link_vals
-        if not (page_raw + x) > total_pages:
-            data['page_links'][page_raw + x] = link + str(page + x) + link_vals
-            if page_raw < total_pages:
-                data['show_lp'] = True
-                data['show_lp_link'] = link + str(total_pages) + link_vals
-    data['page_link_iters'] = sorted(data['page_links'].keys())
+            link_vals += '&check_senders=' + urllib.parse.quote(str(sender))
+
+    # Get the first/previous/next/last page links
+    if page_raw > 1 and checks:
+        data['show_fp'] = True
+        data['show_fp_link'] = link + '1' + link_vals
+        data['show_pp'] = True
+        data['show_pp_link'] = link + str(page_raw - 1) + link_vals + '&after=' + urllib.parse.quote(db.make_cursor(checks[0]))
+    if page_raw < total_pages and checks:
+        data['show_lp'] = True
+        data['show_lp_link'] = link + str(total_pages) + link_vals + '&oldest=1'
+        data['show_np'] = True
+        data['show_np_link'] = link + str(page_raw + 1) + link_vals + '&before=' + urllib.parse.quote(db.make_cursor(checks[-1]))
 
     # Get start and end record display
     data['show_start_end'] = False
@@ -616,7 +638,7 @@ def checks():
         data['show_start_end'] = True
         start_record = (page_raw - 1) * size
         data['start_record'] = format(start_record + 1, ",d")
-        end_record = start_record + size
+        end_record = start_record + len(checks)
         if end_record > total:
             end_record = total
         data['end_record'] = format(end_record, ",d")
@@ -902,6 +924,35 @@ def api_websocket(accessor=None):
     return ''
 
 
+# The last message sent to top clients and the process snapshot it was made from
+top_message = (None, None)
+
+
+# Build the top message once per process snapshot, this also keeps the system
+# CPU load measured between snapshots instead of between client messages
+def get_top_message(snapshot):
+    global top_message
+    if top_message[0] is snapshot:
+        return top_message[1]
+
+    load = psutil.cpu_percent()
+    vir_mem = psutil.virtual_memory().percent
+    swap_mem = psutil.swap_memory().percent
+    pnode = processes.get_node()
+    procs = pnode.iter_snapshot(snapshot, ['pid', 'name', 'username', 'cpu_percent', 'mem_percent'])
+
+    process_list = []
+
+    for process in procs:
+        if process['pid'] == 0:
+            continue
+        process_list.append(process)
+
+    json_val = json.dumps({'load': load, 'vir': vir_mem, 'swap': swap_mem, 'process': process_list})
+    top_message = (snapshot, json_val)
+    return json_val
+
+
 @listener.route('/ws/top', websocket=True)
 @requires_token_or_auth
 @gui_enabled_required
@@ -910,34 +961,27 @@ def top_websocket():
         ws = request.environ['wsgi.websocket']
         listener_logger.info("===== top_websocket() - websocket listening...")
 
-        while not ws.closed:
-            listener_logger.debug("    **** top_websocket() - while open...")
-            load = psutil.cpu_percent()
-            vir_mem = psutil.virtual_memory().percent
-            swap_mem = psutil.swap_memory().percent
-            pnode = processes.get_node()
-            procs = pnode.get_process_dict()
-
-            process_list = []
-
-            for process in procs:
-                if process['pid'] == 0:
+        # All top clients share one process sampler and get the same message
+        # for each snapshot it takes
+        processes.sampler.subscribe()
+        try:
+            while not ws.closed:
+                listener_logger.debug("    **** top_websocket() - while open...")
+                snapshot = processes.sampler.wait()
+                if snapshot is None:
                     continue
-                process_list.append(process)
 
-
-            json_val = json.dumps({'load': load, 'vir': vir_mem, 'swap': swap_mem, 'process': process_list})
-
-            try:
-                ws.send(json_val)
-                gevent.sleep(1)
-            except Exception as e:
-                # Socket was probably closed by the browser changing pages
-                listener_logger.warning("top_websocket Exception: %s", e)
-                ws.close()
-                break
-        else:
-            listener_logger.info("===== top_websocket() - websocket closed.")
+                try:
+                    ws.send(get_top_message(snapshot))
+                except Exception as e:
+                    # Socket was probably closed by the browser changing pages
+                    listener_logger.warning("top_websocket Exception: %s", e)
+                    ws.close()
+                    break
+            else:
+                listener_logger.info("===== top_websocket() - websocket closed.")
+        finally:
+            processes.sampler.unsubscribe()
 
     return ''
 
@@ -1689,6 +1733,103 @@ def edit_check():
     listener_logger.info("edit_check() - updated check: %s to %s", check_to_update, new_values)
     return jsonify({'type': 'success', 'message': 'Check updated. <b>Note</b>: You will need to <b>restart NCPA</b> for the change to take effect.', 'old_check': str(check_to_update), 'new_check': str(new_values)})
 
+# ------------------------------
+# Check History Endpoint
+# ------------------------------
+
+
+@listener.route('/api/agent/checks/history', methods=['GET', 'POST'], provide_automatic_options = False)
+@requires_token_or_auth
+def check_history():
+    """
+    Returns the aggregated check result history from the check log for an accessor
+    and/or sender (who ran the check). Gives counts of each state per time bucket,
+    the time spent in each state, the number of state changes and the last results.
+
+    Arguments: accessor, sender, start and end (unix timestamps, default is the last
+    24 hours), bucket (seconds, default 3600) and last (default 10).
+
+    :rtype: flask.Response
+    """
+    accessor = request.values.get('accessor', '').strip('/')
+    sender = request.values.get('sender', '')
+
+    try:
+        end = float(request.values.get('end', 0)) or None
+        start = float(request.values.get('start', 0)) or None
+        bucket = int(request.values.get('bucket', 3600))
+        last = int(request.values.get('last', 10))
+    except ValueError:
+        return error(msg='Arguments start, end, bucket and last must be numbers.')
+
+    if bucket < 1:
+        return error(msg='Bucket must be at least 1 second.')
+    last = max(0, min(last, 1000))
+
+    db = database.DB()
+    results = db.get_check_history(accessor, sender, start, end, bucket, last)
+
+    response = Response(json.dumps({ 'history': results }, ensure_ascii=False), mimetype='application/json')
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+@listener.route('/api/services/changes', methods=['GET', 'POST'], provide_automatic_options = False)
+@requires_token_or_auth
+def service_changes():
+    """
+    Returns the services that changed state since a unix timestamp, with their new
+    status and when it changed (services that went away have a status of removed).
+    Requires service_cache_interval to be set. Pass the returned time as since on
+    the next request to only get the changes in between.
+
+    :rtype: flask.Response
+    """
+    if not services.cache.get_interval():
+        return error(msg='The service cache is disabled, set service_cache_interval in the [listener] section to use it.')
+
+    try:
+        since = float(request.values.get('since', 0))
+    except ValueError:
+        return error(msg='Argument since must be a unix timestamp.')
+
+    results = { 'time': services.cache.time, 'changes': services.cache.get_changes(since) }
+    response = Response(json.dumps(results, ensure_ascii=False), mimetype='application/json')
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+@listener.route('/api/agent/plugins/queue', methods=['GET', 'POST'], provide_automatic_options = False)
+@requires_token_or_auth
+def plugin_queue():
+    """
+    Returns the plugin concurrency and queue settings with the number of plugins
+    running and waiting, and how many were run, rejected because the queue was
+    full or timed out waiting along with the average and max wait in seconds, in
+    total and for each plugin.
+
+    :rtype: flask.Response
+    """
+    response = Response(json.dumps({ 'queue': pluginexecutor.executor.get_queue_stats() }, ensure_ascii=False), mimetype='application/json')
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+@listener.route('/api/agent/plugins/stats', methods=['GET', 'POST'], provide_automatic_options = False)
+@requires_token_or_auth
+def plugin_stats():
+    """
+    Returns how many times each plugin was run (and answered from the cache), its
+    run time average, max, p50, p95, p99 and histogram in seconds, timeouts, exit
+    codes and bytes of output, in total and for each plugin with the slowest first.
+
+    :rtype: flask.Response
+    """
+    response = Response(json.dumps({ 'stats': pluginexecutor.executor.get_plugin_stats() }, ensure_ascii=False), mimetype='application/json')
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
 # ------------------------------
 # API Endpoint
 # ------------------------------
@@ -1729,6 +1870,21 @@ def api(accessor=''):
     if not 'check' in sane_args:
         sane_args['check'] = request.args.get('check', False)
 
+    # Return the recorded history of the metric instead of the current value
+    history_range = request.args.get('history', None)
+    if history_range:
+        try:
+            duration = history.parse_duration(history_range)
+            points = int(request.args.get('points', 0))
+        except ValueError:
+            return error(msg='Invalid history range: %s' % history_range)
+        value = history.get_history(accessor, duration, points)
+        if value is None:
+            return error(msg='Metric history is not being recorded for: %s' % accessor)
+        response = Response(json.dumps({'history': value}), mimetype='application/json')
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        return response
+
     # Try to get the node that was specified
     try:
         node = psapi.getter(accessor, config, full_path, request.args)
@@ -5,12 +5,76 @@ import subprocess
 import tempfile
 import os
 import psutil
+import shutil
+import gevent
+import gevent.pool
 import listener.server
 import listener.database as database
 import time
 from ncpa import listener_logger as logging
 from stat import ST_MODE,S_IXUSR,S_IXGRP,S_IXOTH
-from threading import Timer
+
+
+# The service backend (the get_services_via_* method) to use, the init system
+# doesn't change while the agent is running so it's only detected once
+init_system = None
+
+# Values of the init_system option and the backend each one uses
+init_systems = {
+    'systemd': 'systemctl',
+    'upstart': 'initctl',
+    'sysv': 'initd',
+    'launchd': 'launchctl',
+    'src': 'lssrc',
+    'smf': 'svcs',
+    'windows': 'psutil',
+}
+
+# Status of init.d scripts from 'service <name> status', keyed by the script name
+# with the time it was checked so scripts aren't run again for every request
+initd_statuses = {}
+
+
+# Find the service backend for this system, unless it's set with init_system in
+# the [listener] section of the config
+def detect_init_system(config=None):
+    global init_system
+
+    try:
+        if config is not None:
+            override = config.get('listener', 'init_system')
+        else:
+            override = listener.server.get_config_value('listener', 'init_system', 'auto')
+    except Exception as e:
+        override = 'auto'
+
+    override = (override or 'auto').strip().lower()
+    if override in init_systems:
+        init_system = init_systems[override]
+        logging.info('Using %s for services (set in config)', override)
+        return init_system
+    elif override != 'auto':
+        logging.warning('Unknown init_system %s in config, detecting it instead', override)
+
+    uname = platform.uname()[0]
+    if uname == 'Windows':
+        init_system = 'psutil'
+    elif uname == 'Darwin':
+        init_system = 'launchctl'
+    elif uname == 'AIX':
+        init_system = 'lssrc'
+    elif uname == 'SunOS':
+        init_system = 'svcs'
+    elif shutil.which('systemctl'):
+        init_system = 'systemctl'
+    elif shutil.which('initctl'):
+        init_system = 'initctl'
+    else:
+        # fall back on sysv init
+        init_system = 'initd'
+
+    logging.debug('Detected %s for services', init_system)
+    return init_system
 
 
 def filter_services(m):
@@ -64,45 +128,19 @@ def filter_services(m):
 class ServiceNode(listener.nodes.LazyNode):
 
     def get_service_method(self, *args, **kwargs):
-        uname = platform.uname()[0]
-
-        if uname == 'Windows':
-            return self.get_services_via_psutil
-        elif uname == 'Darwin':
-            return self.get_services_via_launchctl
-        elif uname == 'AIX':
-            return self.get_services_via_lssrc
-        elif uname == 'SunOS':
-            return self.get_services_via_svcs
-        else:
+        if cache.get_services() is not None:
+            return self.get_services_via_cache
+        return self.get_backend_method()
 
-            # look for systemd
-            is_systemctl = False
-            try:
-                process = subprocess.Popen(['which', 'systemctl'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                process.wait()
-                if process.returncode == 0:
-                    is_systemctl = True
-            except:
-                pass
+    # Get the method that asks the init system itself
+    def get_backend_method(self):
+        if init_system is None:
+            detect_init_system()
+        return getattr(self, 'get_services_via_' + init_system)
 
-            # look for upstart
-            is_upstart = False
-            try:
-                process = subprocess.Popen(['which', 'initctl'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                process.wait()
-                if process.returncode == 0:
-                    is_upstart = True
-            except:
-                pass
-
-            if is_systemctl:
-                return self.get_services_via_systemctl
-            elif is_upstart:
-                return self.get_services_via_initctl
-            else:
-                # fall back on sysv init
-                return self.get_services_via_initd
+    @filter_services
+    def get_services_via_cache(self, *args, **kwargs):
+        return dict(cache.get_services() or {})
 
     @filter_services
     def get_services_via_psutil(self, *args, **kwargs):
@@ -141,8 +179,66 @@ class ServiceNode(listener.nodes.LazyNode):
                 services[label] = 'running'
         return services
 
+    # Get the service names when they are matched exactly and nothing else is
+    # needed, so only those services have to be looked up
+    @staticmethod
+    def get_exact_services(request_args):
+        match = request_args.get('match', None)
+        if isinstance(match, list):
+            match = match[0]
+        if match == 'search' or match == 'regex':
+            return []
+        if [x for x in ServiceNode.get_target_status(request_args) if x]:
+            return []
+
+        services = request_args.get('service', [])
+        if not isinstance(services, list):
+            services = [services]
+        return [x for x in services if x]
+
+    # Ask systemd about specific units only, returns None if the output can't be
+    # matched up with the units so the full list can be used instead
+    def get_systemctl_units(self, names):
+        units = [x if x.endswith('.service') else x + '.service' for x in names]
+        try:
+            process = subprocess.Popen(['systemctl', '--no-pager', 'show', '--property=LoadState,ActiveState,SubState', '--'] + units,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            logging.warning('Could not run systemctl show: %s', e)
+            return None
+
+        try:
+            stdout, stderr = process.communicate(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            logging.warning('Timed out getting service status from systemctl show')
+            return None
+
+        # There is one block of properties for each unit, in the order they were given
+        blocks = [x for x in stdout.decode('utf-8', 'replace').split('\n\n') if x.strip()]
+        if process.returncode != 0 or len(blocks) != len(units):
+            return None
+
+        services = {}
+        for name, block in zip(names, blocks):
+            properties = dict(x.split('=', 1) for x in block.splitlines() if '=' in x)
+            if properties.get('LoadState', 'not-found') == 'not-found':
+                continue
+            if properties.get('ActiveState', '').lower() == 'active' and properties.get('SubState', '').lower() != 'dead':
+                services[name] = 'running'
+            else:
+                services[name] = 'stopped'
+        return services
+
     @filter_services
     def get_services_via_systemctl(self, *args, **kwargs):
+        names = self.get_exact_services(kwargs)
+        if names:
+            services = self.get_systemctl_units(names)
+            if services is not None:
+                return services
+
         services = {}
         status = tempfile.TemporaryFile()
         service = subprocess.Popen(['systemctl', '--no-pager', '--no-legend', '--all', '--type=service', 'list-units', '--plain'], stdout=status)
@@ -193,21 +289,28 @@ class ServiceNode(listener.nodes.LazyNode):
     # Special functions to test if a service is running or not
     # ---------------------------------
 
-    def kill_proc(self, p):
-        p.kill()
+    # Probing init.d scripts is limited to this many at once, a request waits
+    # at most initd_deadline seconds for all of them (and 2 seconds for each one)
+    # and the results are reused for initd_cache_ttl seconds
+    initd_workers = 8
+    initd_deadline = 10
+    initd_cache_ttl = 30
+
+    def get_initd_service_status(self, service, timeout=2):
+        if timeout <= 0:
+            return 'unknown'
 
-    def get_initd_service_status(self, service):
         service_status = subprocess.Popen(['service', service, 'status'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        timer = Timer(2, self.kill_proc, [service_status])
 
         # Stop subprocess if it takes more then 2 seconds to get service status
         try:
-            timer.start()
-            stdout, stderr = service_status.communicate()
-        finally:
-            timer.cancel()
+            stdout, stderr = service_status.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            service_status.kill()
+            service_status.communicate()
+            return 'unknown'
 
-        out = stdout.lower()
+        out = stdout.decode('utf-8', 'replace').lower()
         if 'not running' in out or 'stopped' in out:
             return 'stopped'
 
@@ -220,37 +323,63 @@ class ServiceNode(listener.nodes.LazyNode):
         # Service is likely not running (return > 0)
         return 'unknown'
 
+    # Get the status of init.d scripts that aren't cached, running several at once
+    # with one deadline for all of them
+    def probe_initd_services(self, services):
+        now = time.time()
+        statuses = {}
+        probes = []
+        for service in services:
+            cached = initd_statuses.get(service)
+            if cached is not None and now - cached[0] < self.initd_cache_ttl:
+                statuses[service] = cached[1]
+            else:
+                probes.append(service)
+
+        if not probes:
+            return statuses
+
+        deadline = now + self.initd_deadline
+
+        def probe(service):
+            try:
+                status = self.get_initd_service_status(service, min(2, deadline - time.time()))
+            except Exception as e:
+                logging.exception(e)
+                status = 'unknown'
+            if status != 'unknown' or time.time() < deadline:
+                initd_statuses[service] = (time.time(), status)
+            return service, status
+
+        pool = gevent.pool.Pool(self.initd_workers)
+        for service, status in pool.imap_unordered(probe, probes):
+            statuses[service] = status
+        return statuses
+
     @filter_services
     def get_services_via_initd(self, *args, **kwargs):
         # Only look at executable files in init.d (there is no README service)
         try:
-            possible_services = filter(lambda x: os.stat('/etc/init.d/'+x)[ST_MODE] & (S_IXUSR|S_IXGRP|S_IXOTH), os.listdir('/etc/init.d'))
+            possible_services = [x for x in os.listdir('/etc/init.d') if os.stat('/etc/init.d/'+x)[ST_MODE] & (S_IXUSR|S_IXGRP|S_IXOTH)]
         except OSError as e:
             logging.exception(e);
-            pass
+            return {}
 
         services = {}
-        processes = []
-        for p in psutil.process_iter(attrs=['name']):
-            processes.append(p.info['name'])
+        processes = set(p.info['name'] for p in psutil.process_iter(attrs=['name']))
 
-        for service in possible_services:
-            status = 'unknown'
+        # Skip broken 'services' that actually run when called with 'status'
+        possible_services = [x for x in possible_services if 'rcS' not in x]
 
-            # Skip broken 'services' that actually run when called with 'status'
-            if 'rcS' in service:
-                continue
-
-            # Do a quick check if there is a process for this service running
-            for p in processes:
-                if service == p:
-                    status = 'running'
-
-            # Verify with 'service' if status is still stopped
-            if status == 'unknown':
-                status = self.get_initd_service_status(service)
-
-            services[service] = status
+        # Do a quick check if there is a process for this service running and
+        # verify the rest with 'service'
+        unknown = []
+        for service in possible_services:
+            if service in processes:
+                services[service] = 'running'
+            else:
+                unknown.append(service)
+        services.update(self.probe_initd_services(unknown))
 
         return services
 
@@ -424,6 +553,80 @@ class ServiceNode(listener.nodes.LazyNode):
 
         return { 'stdout': stdout, 'returncode': returncode }
 
+# Keeps the status of all services, refreshed in the background every
+# service_cache_interval seconds (when it's set), along with the last time each
+# service changed state so clients can ask for only the services that changed
+class ServiceCache(object):
+
+    # Seconds to keep the changes for, so services that come and go (i.e. transient
+    # units) don't pile up
+    changes_retention = 86400
+
+    def __init__(self):
+        self.services = {}
+        self.changes = {}
+        self.time = 0
+        self.greenlet = None
+
+    def get_interval(self):
+        try:
+            interval = listener.server.get_config_value('listener', 'service_cache_interval', 0)
+            return max(0, float(interval or 0))
+        except (TypeError, ValueError):
+            return 0
+
+    # The cached services, or None if the cache is disabled or hasn't been
+    # refreshed recently enough to be trusted
+    def get_services(self):
+        interval = self.get_interval()
+        if interval and self.time and time.time() - self.time <= interval * 2:
+            return self.services
+        return None
+
+    # Save a new list of services and when each one changed, services that are
+    # no longer listed are kept in the changes as removed until the changes are
+    # older than changes_retention
+    def update(self, services, now=None):
+        if now is None:
+            now = time.time()
+        for service, status in services.items():
+            if self.services.get(service) != status:
+                self.changes[service] = (now, status)
+        for service in set(self.services) - set(services):
+            self.changes[service] = (now, 'removed')
+        for service, (changed, status) in list(self.changes.items()):
+            if now - changed > self.changes_retention:
+                del self.changes[service]
+        self.services = services
+        self.time = now
+
+    def get_changes(self, since=0):
+        changes = {}
+        for service, (changed, status) in self.changes.items():
+            if changed > since:
+                changes[service] = {'status': status, 'changed': changed}
+        return changes
+
+    def start(self):
+        if self.get_interval() and (self.greenlet is None or self.greenlet.dead):
+            self.greenlet = gevent.spawn(self.run)
+        return self.greenlet
+
+    def run(self):
+        node = get_node()
+        logging.info('Caching services every %s seconds', self.get_interval())
+        while self.get_interval():
+            start = time.time()
+            try:
+                self.update(node.get_backend_method()())
+            except Exception as e:
+                logging.exception(e)
+            gevent.sleep(max(0, self.get_interval() - (time.time() - start)))
+
+
+cache = ServiceCache()
+
+
 def get_node():
     logging.debug("get_node() was called for services")
     return ServiceNode('services', None)
@@ -35,6 +35,7 @@ import psutil
 
 import errno
 import signal
+import gevent
 
 from argparse import ArgumentParser
 from configparser import ConfigParser
@@ -74,6 +75,7 @@ import listener.server
 import listener.psapi
 import listener.certificate as certificate
 import listener.database as database
+import listener.history as history
 
 # Imports for different system types
 if os.name == 'posix':
@@ -130,6 +132,8 @@ cfg_defaults = {
             'general': {
                 'check_logging': '1',
                 'check_logging_time': '30',
+                'check_search_index': '0',
+                'check_logging_vacuum': '0',
                 'loglevel': 'info',
                 'logmaxmb': '5',
                 'logbackups': '5',
@@ -157,6 +161,12 @@ cfg_defaults = {
                 'allowed_sources': '',
                 'allow_config_edit': '1', # Note: this is limited to non-sensitive settings
                 'disable_gui': '0',  # Disable web GUI while preserving API
+                'process_sample_interval': '1',
+                'process_index_interval': '60',
+                'process_output_lines': '100',
+                'process_output_bytes': '16384',
+                'init_system': 'auto',
+                'service_cache_interval': '0',
             },
             'api': {
                 'community_string': 'mytoken',
@@ -184,6 +194,14 @@ cfg_defaults = {
                 'plugin_path': 'plugins/',
                 'follow_symlinks': '0',
                 'plugin_timeout': '59',
+                'plugin_concurrency': '20',
+                'plugin_concurrency_limits': '',
+                'plugin_queue_size': '100',
+                'plugin_queue_timeout': '30',
+                'plugin_cache_ttl': '',
+                'python_workers': '0',
+                'plugin_output_max': '1048576',
+                'plugin_stderr': 'merge',
                 'run_with_sudo': '',
                 '.sh': '/bin/sh $plugin_name $plugin_args',
                 '.py': 'python3 $plugin_name $plugin_args',
@@ -194,7 +212,15 @@ cfg_defaults = {
                 '.wsf': 'cscript $plugin_name $plugin_args //NoLogo',
                 '.bat': 'cmd /c $plugin_name $plugin_args',
             },
-            'passive checks' : {}
+            'passive checks' : {},
+            'metric history': {
+                'enabled': '0',
+                'interval': '60',
+                'retention': '6h',
+                'minute_retention': '2d',
+                'hour_retention': '30d',
+                'accessors': 'cpu/percent,memory/virtual/percent,memory/swap/percent',
+            },
         }
 
 # --------------------------
@@ -318,6 +344,15 @@ class Listener(Base):
             # Pass config to Flask instance
             listener.server.listener.config['iconfig'] = self.config
 
+            # Start recording metric history (if enabled)
+            history.start(self.config)
+
+            # Find the init system used for services once
+            listener.services.detect_init_system(self.config)
+
+            # Start refreshing the service cache (if enabled)
+            listener.services.cache.start()
+
             # Create connection pool
             listener.server.listener.secret_key = os.urandom(24)
             logger.debug("run() - define http_server")
@@ -414,9 +449,11 @@ class Passive(Base):
             logger.exception("run() - exception: %s", e)
             pass
 
+        # DB maintenance runs in the background (it deletes old checks in small batches
+        # with pauses between them) so passive checks keep running while it works.
         # Set next DB maintenance period to +1 day
         self.db = database.DB()
-        self.db.run_db_maintenance(self.config)
+        db_maintenance = gevent.spawn(self.db.run_db_maintenance, self.config)
         next_db_maintenance = datetime.datetime.now() + datetime.timedelta(days=1)
 
         try:
@@ -424,9 +461,9 @@ class Passive(Base):
                 self.run_all_handlers()
 
                 # Do DB maintenance if the time is greater than next DB maintenance run
-                if datetime.datetime.now() > next_db_maintenance:
+                if datetime.datetime.now() > next_db_maintenance and db_maintenance.ready():
                     logger.info("run() - doing DB maintenance")
-                    self.db.run_db_maintenance(self.config)
+                    db_maintenance = gevent.spawn(self.db.run_db_maintenance, self.config)
                     next_db_maintenance = datetime.datetime.now() + datetime.timedelta(days=1)
 
                 logger.debug("run() - loop - running")
@@ -1260,7 +1297,7 @@ def start_processes(options, config, has_error):
     try:
         # Create the database structure for checks
         db = database.DB()
-        db.setup()
+        db.setup(config)
         l = p = ''
 
         if not options.get('listener_only') or options.get('passive_only'):
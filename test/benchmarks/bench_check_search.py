@@ -0,0 +1,93 @@
+"""
+Benchmark for searching the check log with and without the full-text search index.
+
+Generates a large check history in a temporary database and times a search page
+(get_checks + get_checks_count, like /gui/checks does) using LIKE and using FTS5.
+
+Usage: python bench_check_search.py [--rows 500000] [--runs 5]
+"""
+
+import os
+import sys
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../agent/'))
+import includes_for_tests
+import listener.server
+import listener.database as database
+
+
+ACCESSORS = ['cpu/percent', 'memory/virtual', 'disk/logical/|', 'processes', 'services',
+             'plugins/check_raid.sh', 'plugins/check_mysql.py', 'interface/eth0/bytes_sent']
+WORDS = ['OK', 'WARNING', 'CRITICAL', 'usage', 'was', 'process', 'count', 'service',
+         'running', 'stopped', 'database', 'replication', 'lag', 'seconds', 'raid', 'degraded']
+
+
+def make_db(path, rows):
+    db = database.DB()
+    db.close()
+    db.dbfile = path
+    db.connect()
+    db.setup_search_index(False)
+    db.setup()
+
+    now = time.time()
+    db.cursor.execute('BEGIN')
+    for i in range(rows):
+        output = ' '.join(random.choice(WORDS) for _ in range(8)) + ' %d' % i
+        db.add_check(random.choice(ACCESSORS), now - i, now - i, random.randint(0, 3),
+                     output, random.choice(['127.0.0.1', 'Internal']), 'Active')
+    db.cursor.execute('COMMIT')
+    return db
+
+
+def time_search(db, search, runs):
+    timings = []
+    for _ in range(runs):
+        database.search_counts.clear()
+        start = time.time()
+        db.get_checks(search, 20, 1)
+        db.get_checks_count(search)
+        timings.append(time.time() - start)
+    return min(timings) * 1000
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(1)
+    path = os.path.join(tempfile.mkdtemp(), 'ncpa.db')
+    print('Generating %d checks...' % args.rows)
+    db = make_db(path, args.rows)
+
+    searches = ['replication lag', 'degraded', '%d' % (args.rows // 2)]
+    results = {}
+    for search in searches:
+        results[search] = [time_search(db, search, args.runs)]
+
+    start = time.time()
+    if not db.setup_search_index(True):
+        print('sqlite3 was built without FTS5, only LIKE can be measured.')
+        return
+    print('Built search index in %.2f s' % (time.time() - start))
+
+    for search in searches:
+        results[search].append(time_search(db, search, args.runs))
+
+    print('%-20s %12s %12s' % ('search', 'LIKE (ms)', 'MATCH (ms)'))
+    for search in searches:
+        print('%-20s %12.2f %12.2f' % (search, results[search][0], results[search][1]))
+
+    db.close()
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
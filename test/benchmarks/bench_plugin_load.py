@@ -0,0 +1,97 @@
+"""
+Load test for API requests while plugins are hanging.
+
+Serves the listener on a local port with a small HTTP pool (like max_connections),
+starts more plugin requests than the pool has slots using a plugin that sleeps and
+then times cheap /api/cpu/count requests. Without limits the plugin requests take
+every HTTP slot and cpu/count waits for the plugins to finish. With the plugin
+concurrency and queue size below the pool size the extra plugin requests are
+answered with UNKNOWN right away and cpu/count stays fast.
+
+Usage: python bench_plugin_load.py [--connections 10] [--plugins 30] [--sleep 3]
+                                   [--concurrency 4] [--queue 4]
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import urllib.request
+from argparse import ArgumentParser
+from configparser import ConfigParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../agent/'))
+import includes_for_tests
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+import listener.server
+import listener.pluginexecutor as pluginexecutor
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=120) as response:
+        return response.read()
+
+
+def run_load(args, plugin_path, concurrency, queue):
+    config = ConfigParser()
+    config.read_dict({
+        'general': {'check_logging': '0'},
+        'api': {'community_string': 'mytoken', 'backup_community_string': ''},
+        'plugin directives': {'plugin_path': plugin_path, 'plugin_timeout': '60',
+                              'plugin_concurrency': str(concurrency), 'plugin_queue_size': str(queue)},
+    })
+    listener.server.listener.config['iconfig'] = config
+    pluginexecutor.executor = pluginexecutor.PluginExecutor()
+
+    server = WSGIServer(('127.0.0.1', 0), listener.server.listener, spawn=Pool(args.connections), log=None)
+    server.start()
+    base = 'http://127.0.0.1:%d/api/' % server.server_port
+
+    try:
+        plugins = [gevent.spawn(get, base + 'plugins/check_sleep.sh?token=mytoken') for _ in range(args.plugins)]
+        gevent.sleep(0.5)
+
+        timings = []
+        for _ in range(5):
+            start = time.time()
+            get(base + 'cpu/count?token=mytoken')
+            timings.append((time.time() - start) * 1000)
+
+        gevent.joinall(plugins)
+        return timings
+    finally:
+        server.stop()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--connections', type=int, default=10)
+    parser.add_argument('--plugins', type=int, default=30)
+    parser.add_argument('--sleep', type=float, default=3)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--queue', type=int, default=4)
+    args = parser.parse_args()
+
+    plugin_path = tempfile.mkdtemp()
+    plugin = os.path.join(plugin_path, 'check_sleep.sh')
+    with open(plugin, 'w') as f:
+        f.write('#!/bin/sh\nsleep %s\necho "OK: slept"\n' % args.sleep)
+    os.chmod(plugin, 0o755)
+
+    try:
+        listener.server.__INTERNAL__ = True
+        print('%d plugin requests sleeping %ss, %d HTTP pool slots' % (args.plugins, args.sleep, args.connections))
+        limits = (('no limits', args.plugins, args.plugins), ('bounded queue', args.concurrency, args.queue))
+        for name, concurrency, queue in limits:
+            timings = run_load(args, plugin_path, concurrency, queue)
+            print('%-16s cpu/count max %8.1f ms, avg %8.1f ms' % (name, max(timings), sum(timings) / len(timings)))
+    finally:
+        shutil.rmtree(plugin_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark for the memory used reading the output of a plugin that writes too much.
+
+Runs a plugin that writes a lot of output through the plugin executor, which keeps
+at most plugin_output_max bytes of it, and then the way it was done before (all of
+it read with communicate() and cleaned up with replace()) and shows how much the
+peak memory of the process went up for each. The executor is run first since the
+peak can only go up.
+
+Usage: python bench_plugin_output.py [--size 200] [--max 1048576]
+"""
+
+import os
+import sys
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser
+from configparser import ConfigParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../agent/'))
+import includes_for_tests
+import listener.server
+import listener.pluginexecutor as pluginexecutor
+import listener.pluginnodes as pluginnodes
+
+
+# The way plugin output was read before
+def legacy_run(cmd):
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    stdout, stderr = process.communicate(timeout=60)
+    return stdout.decode('utf-8', 'ignore').replace('\r\n', '\n').replace('\r', '\n').strip()
+
+
+def new_run(cmd):
+    result = pluginexecutor.executor.execute(cmd, 60)
+    return pluginnodes.PluginNode.clean_output(result.stdout)
+
+
+def peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--size', type=int, default=200, help='MB of output the plugin writes')
+    parser.add_argument('--max', type=int, default=1048576, help='plugin_output_max')
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read_dict({'plugin directives': {'plugin_output_max': str(args.max)}})
+    listener.server.listener.config['iconfig'] = config
+
+    plugin_path = tempfile.mkdtemp()
+    plugin = os.path.join(plugin_path, 'check_loud.sh')
+    with open(plugin, 'w') as f:
+        f.write('#!/bin/sh\necho "OK: loud"\nhead -c %d /dev/zero | tr "\\0" x\n' % (args.size * 1024 * 1024))
+    os.chmod(plugin, 0o755)
+
+    try:
+        print('Plugin writing %d MB of output' % args.size)
+        for name, method in (('plugin executor', new_run), ('communicate', legacy_run)):
+            before = peak_mb()
+            start = time.time()
+            output = method([plugin])
+            print('%-16s %8.1f ms, peak memory +%8.1f MB, kept %d bytes' % (
+                name, (time.time() - start) * 1000, peak_mb() - before, len(output)))
+    finally:
+        shutil.rmtree(plugin_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark for scanning the process table like /api/processes does.
+
+Starts a number of idle child processes to make a large process table and times
+the old per-attribute scan (each psutil call reads /proc again) against the
+single pass scan in ProcessNode.get_process_dict(), both for the full API output
+and for the fields a process check needs, and an exact name check which uses the
+process index.
+
+Usage: python bench_process_scan.py [--procs 5000] [--runs 5]
+"""
+
+import os
+import sys
+import subprocess
+import time
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../agent/'))
+import includes_for_tests
+import listener.server
+import listener.processes as processes
+import psutil
+
+
+# The scan as it was done before, calling psutil once per attribute
+def legacy_scan(units='B'):
+    node = processes.get_node()
+    procs = []
+    for process in psutil.process_iter():
+        proc = {'pid': process.pid}
+        for name, method in (('cmd', lambda: ' '.join(process.cmdline())), ('name', process.name),
+                             ('exe', process.exe), ('username', process.username)):
+            try:
+                proc[name] = method()
+            except BaseException:
+                proc[name] = 'Unknown'
+        try:
+            proc['cpu_percent'] = (round(process.cpu_percent(None) / psutil.cpu_count(), 2), '%')
+        except BaseException:
+            proc['cpu_percent'] = (0, '%')
+        try:
+            proc['mem_percent'] = (round(process.memory_percent(), 2), '%')
+        except BaseException:
+            proc['mem_percent'] = (0, '%')
+        try:
+            pmi = process.memory_info()
+            proc['mem_rss'] = (node.adjust_scale(node, pmi.rss, units)[0], 'B')
+            proc['mem_vms'] = (node.adjust_scale(node, pmi.vms, units)[0], 'B')
+        except BaseException:
+            proc['mem_rss'], proc['mem_vms'] = (0, 'B'), (0, 'B')
+        procs.append(proc)
+    return procs
+
+
+# An exact name check without the shared snapshot, after the first run the index
+# is used instead of a full scan
+def indexed_check(node):
+    processes.sampler.snapshot = None
+    return node.get_process_dict(output_fields=node.check_fields, name=[psutil.Process().name()])
+
+
+def time_scan(method, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        method()
+        timings.append(time.time() - start)
+    return min(timings) * 1000
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--procs', type=int, default=5000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    # Idle children to fill up the process table
+    children = []
+    print('Starting %d processes...' % args.procs)
+    try:
+        for _ in range(args.procs):
+            children.append(subprocess.Popen(['sleep', '600']))
+    except OSError as e:
+        print('Could only start %d processes: %s' % (len(children), e))
+
+    try:
+        node = processes.get_node()
+        results = [
+            ('legacy scan', time_scan(legacy_scan, args.runs)),
+            ('single pass (api)', time_scan(lambda: node.get_process_dict(fresh=['1']), args.runs)),
+            ('single pass (check)', time_scan(lambda: node.get_process_dict(output_fields=node.check_fields, fresh=['1']), args.runs)),
+            ('indexed (own name)', time_scan(lambda: indexed_check(node), args.runs)),
+        ]
+        print('%d processes' % len(psutil.pids()))
+        for name, timing in results:
+            print('%-20s %10.2f ms' % (name, timing))
+    finally:
+        for child in children:
+            child.kill()
+            child.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark for running Python plugins in the Python worker pool.
+
+Writes a small Python plugin that imports a few modules from the standard library
+like most plugins do and times running it through the plugin executor as a new
+process for each check against running it in a Python worker (python_workers).
+
+Usage: python bench_python_plugins.py [--runs 50] [--workers 2]
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from configparser import ConfigParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../agent/'))
+import includes_for_tests
+import listener.server
+import listener.pluginexecutor as pluginexecutor
+import listener.pluginworkers as pluginworkers
+
+PLUGIN = '''# ncpa: worker
+import argparse, json, logging, subprocess, urllib.request
+parser = argparse.ArgumentParser()
+parser.add_argument("-w", type=float, default=80)
+args = parser.parse_args()
+print("OK: %s" % json.dumps({"warning": args.w}))
+'''
+
+
+def time_runs(plugin, runs, workers):
+    config = ConfigParser()
+    config.read_dict({'plugin directives': {'python_workers': str(workers)}})
+    listener.server.listener.config['iconfig'] = config
+
+    cmd = [sys.executable, plugin, '-w', '90']
+    pluginexecutor.executor.execute(cmd, 10, plugin)
+
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        result = pluginexecutor.executor.execute(cmd, 10, plugin)
+        timings.append((time.time() - start) * 1000)
+        assert result.returncode == 0, result.stdout
+    timings.sort()
+    return timings[len(timings) // 2], sum(timings) / len(timings)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    plugin_path = tempfile.mkdtemp()
+    plugin = os.path.join(plugin_path, 'check_python.py')
+    with open(plugin, 'w') as f:
+        f.write(PLUGIN)
+
+    try:
+        print('%d runs of a Python plugin' % args.runs)
+        for name, workers in (('new process', 0), ('python workers', args.workers)):
+            median, avg = time_runs(plugin, args.runs, workers)
+            print('%-16s median %8.2f ms, avg %8.2f ms' % (name, median, avg))
+    finally:
+        for pool in pluginworkers.pools.values():
+            pool.close()
+        shutil.rmtree(plugin_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark for the work a service check does before and while getting services.
+
+Times finding the init system the old way (running 'which' for systemctl and
+initctl on every request) against the cached detection, and a full service check
+for a single service. With systemd it also compares listing every unit with
+querying only the checked units (systemctl show).
+
+Usage: python bench_services.py [--service sshd] [--runs 20]
+"""
+
+import os
+import sys
+import subprocess
+import time
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../agent/'))
+import includes_for_tests
+import listener.server
+import listener.services as services
+
+
+# Finding the init system as it was done before, on every request
+def legacy_detect():
+    found = []
+    for command in ('systemctl', 'initctl'):
+        try:
+            process = subprocess.Popen(['which', command], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            process.wait()
+            found.append(process.returncode == 0)
+        except OSError:
+            found.append(False)
+    return found
+
+
+def time_method(method, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        method()
+        timings.append(time.time() - start)
+    return min(timings) * 1000
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--service', default='sshd')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    listener.server.__INTERNAL__ = True
+    node = services.get_node()
+    check = {'service': [args.service], 'config': None, 'accessor': 'services', 'remote_addr': 'bench'}
+
+    results = [
+        ('legacy detection', time_method(legacy_detect, args.runs)),
+        ('cached detection', time_method(node.get_service_method, args.runs)),
+        ('service check', time_method(lambda: node.run_check(**dict(check)), args.runs)),
+    ]
+    if services.init_system == 'systemctl':
+        results += [
+            ('systemd list-units', time_method(lambda: node.get_services_via_systemctl(service=[args.service], match=['search']), args.runs)),
+            ('systemd show', time_method(lambda: node.get_services_via_systemctl(service=[args.service]), args.runs)),
+        ]
+    print('init system: %s' % services.init_system)
+    for name, timing in results:
+        print('%-20s %10.3f ms' % (name, timing))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import includes_for_tests
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.database
+
+
+class TestDB(unittest.TestCase):
+
+    def setUp(self):
+        listener.database.search_counts.clear()
+        self.testing_dir = tempfile.mkdtemp()
+        self.db = listener.database.DB()
+        self.db.close()
+        self.db.dbfile = os.path.join(self.testing_dir, 'ncpa.db')
+        self.db.connect()
+        self.db.setup()
+
+        # Two checks share each run_time_start to make sure paging doesn't skip ties
+        self.now = int(time.time())
+        for i in range(50):
+            sender = 'Internal' if i % 5 == 0 else '127.0.0.1'
+            self.db.add_check('cpu/percent', self.now + i // 2, self.now + i // 2, i % 4,
+                              'OK: check %d\nlong output' % i, sender, 'Active')
+
+    def tearDown(self):
+        self.db.close()
+        os.remove(self.db.dbfile)
+        os.rmdir(self.testing_dir)
+
+    def test_get_checks_count(self):
+        self.assertEqual(self.db.get_checks_count(), 50)
+        self.assertEqual(self.db.get_checks_count(status=1), 13)
+        self.assertEqual(self.db.get_checks_count(senders=['Internal']), 10)
+        self.assertEqual(self.db.get_checks_count(ctype='Passive'), 0)
+
+    def test_get_checks_count_search(self):
+        self.assertEqual(self.db.get_checks_count('check 1'), 11)
+
+        # Cached counts pick up new rows and removed rows
+        self.db.add_check('cpu/percent', self.now + 100, self.now + 100, 0, 'OK: check 100', 'Internal', 'Active')
+        self.assertEqual(self.db.get_checks_count('check 1'), 12)
+        self.db.cursor.execute('DELETE FROM checks WHERE run_time_start = ?', (self.now + 100,))
+        self.assertEqual(self.db.get_checks_count('check 1'), 11)
+
+    def test_search_counts_limit(self):
+        self.addCleanup(setattr, listener.database, 'search_counts_max', listener.database.search_counts_max)
+        listener.database.search_counts_max = 3
+        for search in ('check 1', 'check 2', 'check 3', 'check 1', 'check 4'):
+            self.db.get_checks_count(search)
+
+        # The least recently used search is dropped first
+        self.assertEqual([x[0] for x in listener.database.search_counts], ['check 3', 'check 1', 'check 4'])
+
+    def test_search_index(self):
+        if not self.db.setup_search_index(True):
+            self.skipTest('sqlite3 was built without FTS5')
+        listener.database.search_counts.clear()
+
+        self.assertTrue(self.db.has_search_index())
+        self.assertEqual(self.db.get_checks_count('check 1'), 11)
+        self.assertEqual(self.db.get_checks_count('cpu'), 50)
+        self.assertEqual(len(self.db.get_checks('check 4', size=20)), 11)
+
+        # Searches that aren't only words match any part of the text
+        self.assertFalse(self.db.use_search_index('cpu/perc'))
+        self.assertEqual(self.db.get_checks_count('cpu/perc'), 50)
+        self.assertEqual(self.db.get_checks_count('K: check 1'), 11)
+        self.assertEqual(self.db.get_checks_count('heck 1'), 0)
+
+        # Deleted checks are removed from the index
+        self.db.cursor.execute('DELETE FROM checks WHERE rowid <= 25')
+        self.assertEqual(self.db.get_checks_count('check 1'), 0)
+
+    def test_search_index_disabled(self):
+        self.db.setup_search_index(False)
+
+        self.assertFalse(self.db.has_search_index())
+        self.assertEqual(self.db.get_checks_count('heck 1'), 11)
+
+    def test_make_search_query(self):
+        self.assertEqual(self.db.make_search_query('say "hi"'), '"say ""hi""" *')
+
+    def test_get_check_senders(self):
+        self.assertEqual(self.db.get_check_senders(), ['127.0.0.1', 'Internal'])
+
+    def test_get_checks_cursor_pages(self):
+        seen = []
+        cursor = None
+        while True:
+            checks = self.db.get_checks(size=15, before=cursor)
+            if not checks:
+                break
+            seen += [x['rowid'] for x in checks]
+            cursor = self.db.make_cursor(checks[-1])
+
+        self.assertEqual(seen, list(range(50, 0, -1)))
+
+    def test_get_checks_after_cursor(self):
+        first = self.db.get_checks(size=15)
+        second = self.db.get_checks(size=15, before=self.db.make_cursor(first[-1]))
+        previous = self.db.get_checks(size=15, after=self.db.make_cursor(second[0]))
+
+        self.assertEqual(first, previous)
+
+    def test_get_checks_oldest(self):
+        checks = self.db.get_checks(size=5, oldest=True)
+        self.assertEqual([x['rowid'] for x in checks], [5, 4, 3, 2, 1])
+
+    def test_get_checks_longoutput(self):
+        check = self.db.get_checks(size=1)[0]
+        self.assertEqual(check['output'], 'OK: check 49')
+        self.assertEqual(check['longoutput'], 'long output')
+
+    def test_run_db_maintenance(self):
+        self.db.prune_batch_size = 4
+        self.db.prune_pause = 0
+
+        # Add checks from well past the default 30 day retention
+        for i in range(30):
+            self.db.add_check('memory/virtual', 100 + i, 100 + i, 0, 'OK: old check', 'Internal', 'Active')
+
+        stats = self.db.run_db_maintenance(None)
+
+        self.assertEqual(stats['rows_pruned'], 30)
+        self.assertGreater(stats['batches'], 1)
+        self.assertEqual(self.db.get_checks_count(), 50)
+        self.assertEqual(self.db.get_checks_count(senders=['Internal']), 10)
+        self.assertEqual(self.db.get_maintenance_stats()['rows_pruned'], 30)
+
+    def test_get_check_history(self):
+        for i, result in enumerate([0, 0, 2, 2, 0, 1]):
+            self.db.add_check('disk/logical/|', self.now + i * 60, self.now + i * 60, result,
+                              'check %d' % i, 'Internal', 'Passive')
+
+        history = self.db.get_check_history('disk/logical/|', start=self.now, end=self.now + 360, bucket=120, last=2)
+
+        self.assertEqual(sum(x['total'] for x in history['buckets']), 6)
+        self.assertEqual(sum(x['critical'] for x in history['buckets']), 2)
+        self.assertEqual(history['flaps'], 3)
+        self.assertEqual(history['time_in_state'], {'ok': 180, 'warning': 60, 'critical': 120, 'unknown': 0})
+        self.assertEqual([x['output'] for x in history['last']], ['check 5', 'check 4'])
+
+    def test_get_check_history_sender(self):
+        history = self.db.get_check_history(sender='Internal', start=self.now, end=self.now + 30, last=0)
+
+        self.assertEqual(sum(x['total'] for x in history['buckets']), 10)
+        self.assertEqual(history['last'], [])
+
+    def test_parse_cursor(self):
+        self.assertEqual(self.db.parse_cursor('1000.5:12'), (1000.5, 12))
+        self.assertIsNone(self.db.parse_cursor('bogus'))
+        self.assertIsNone(self.db.parse_cursor(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
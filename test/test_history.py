@@ -0,0 +1,199 @@
+import includes_for_tests
+import os
+import sys
+import shutil
+import tempfile
+import time
+import unittest
+from configparser import ConfigParser
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.history as history
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.testing_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.testing_dir, 'test.hist')
+        self.ring = history.RingBuffer(self.path, 10)
+
+    def tearDown(self):
+        self.ring.close()
+        shutil.rmtree(self.testing_dir)
+
+    def test_append_wraps(self):
+        for i in range(25):
+            self.ring.append(1000 + i, [i])
+
+        self.assertEqual(os.path.getsize(self.path), history.HEADER_SIZE + 10 * 2 * 8)
+        self.assertEqual([x[1] for x in self.ring.records()], list(range(15, 25)))
+
+    def test_append_out_of_order(self):
+        self.assertTrue(self.ring.append(1000, [1]))
+        self.assertFalse(self.ring.append(1000, [2]))
+        self.assertFalse(self.ring.append(999, [3]))
+        self.assertEqual(self.ring.records(), [(1000, 1)])
+
+    def test_records_range(self):
+        for i in range(15):
+            self.ring.append(1000 + i * 10, [i])
+
+        records = self.ring.records(1075, 1120)
+        self.assertEqual([x[0] for x in records], [1080, 1090, 1100, 1110, 1120])
+
+    def test_reopen(self):
+        for i in range(5):
+            self.ring.append(1000 + i, [i / 2])
+        self.ring.set_unit('%')
+        self.ring.close()
+
+        self.ring = history.RingBuffer(self.path, 10)
+        self.assertEqual(self.ring.unit, '%')
+        self.assertEqual(self.ring.records()[-1], (1004, 2.0))
+
+    def test_resize_keeps_newest(self):
+        for i in range(10):
+            self.ring.append(1000 + i, [i])
+        self.ring.close()
+
+        self.ring = history.RingBuffer(self.path, 4)
+        self.assertEqual([x[1] for x in self.ring.records()], [6, 7, 8, 9])
+        self.assertEqual(os.path.getsize(self.path), history.HEADER_SIZE + 4 * 2 * 8)
+
+    def test_reopen_truncated(self):
+        for i in range(5):
+            self.ring.append(1000 + i, [i])
+        self.ring.close()
+
+        # A file cut short is replaced instead of being copied from
+        for capacity in (10, 4):
+            with open(self.path, 'r+b') as f:
+                f.truncate(history.HEADER_SIZE + 24)
+            self.ring = history.RingBuffer(self.path, capacity)
+            self.assertEqual(self.ring.records(), [])
+            self.assertEqual(os.path.getsize(self.path), history.HEADER_SIZE + capacity * 2 * 8)
+            self.ring.close()
+        self.ring = history.RingBuffer(self.path, 4)
+
+    def test_rollup(self):
+        rollup = history.RingBuffer(os.path.join(self.testing_dir, 'test.1m.hist'), 10, 4, 60)
+        for i, value in enumerate([5, 1, 9, 3, 4]):
+            rollup.add_sample(1200 + i * 30, value)
+
+        # The last bucket is still being filled but is included in the records
+        self.assertEqual(rollup.records(), [(1200, 1, 5, 3, 1), (1260, 3, 9, 6, 3), (1320, 4, 4, 4, 4)])
+        self.assertEqual(rollup.count, 2)
+
+        # The partial bucket is kept across restarts
+        rollup.close()
+        rollup = history.RingBuffer(rollup.path, 10, 4, 60)
+        rollup.add_sample(1350, 8)
+        self.assertEqual(rollup.records(1300), [(1320, 4, 8, 6, 8)])
+        rollup.close()
+
+    def test_resize_rollup_partial_bucket(self):
+        rollup = history.RingBuffer(os.path.join(self.testing_dir, 'test.1m.hist'), 10, 4, 60)
+        for i, value in enumerate([1, 3, 5]):
+            rollup.add_sample(1200 + i * 30, value)
+        rollup.close()
+
+        # The bucket being filled keeps getting samples after a resize
+        rollup = history.RingBuffer(rollup.path, 5, 4, 60)
+        rollup.add_sample(1290, 7)
+        rollup.add_sample(1320, 2)
+        self.assertEqual(rollup.records(), [(1200, 1, 3, 2, 3), (1260, 5, 7, 6, 7), (1320, 2, 2, 2, 2)])
+        self.assertEqual(rollup.count, 2)
+        rollup.close()
+
+    def test_series_resolution(self):
+        metric = history.Series(self.testing_dir, 'cpu/percent', 10, 600, [(60, '1m', 7200), (3600, '1h', 86400)])
+        for i in range(360):
+            metric.append(100000 + i * 10, i)
+
+        end = 100000 + 3590
+        self.assertEqual(metric.get_ring(end - 300, end).resolution, 0)
+        self.assertEqual(metric.get_ring(end - 300, end, 10).resolution, 60)
+        self.assertEqual(metric.get_ring(end - 3000, end).resolution, 60)
+        self.assertEqual(metric.get_ring(end - 3000, end, 10).resolution, 3600)
+        self.assertEqual(len(metric.rings[0].records()), 60)
+        self.assertEqual(metric.rings[1].records()[0], (99960, 0, 1, 0.5, 1))
+        metric.close()
+
+    def test_series_default_interval(self):
+        # With the default 60 second interval the samples are kept for the
+        # minute retention since they are already at that resolution
+        metric = history.Series(self.testing_dir, 'cpu/percent', 60, 21600, [(60, '1m', 172800), (3600, '1h', 2592000)])
+        for i in range(1440):
+            metric.append(100000 + i * 60, i)
+
+        end = 100000 + 1439 * 60
+        self.assertEqual(len(metric.rings), 2)
+        self.assertEqual(metric.rings[0].capacity, 2880)
+        ring = metric.get_ring(end - 43200, end)
+        self.assertEqual(ring.resolution, 0)
+        self.assertEqual(len([x for x in ring.records() if x[0] >= end - 43200]), 721)
+        metric.close()
+
+
+class TestRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.testing_dir = tempfile.mkdtemp()
+        self.config = ConfigParser()
+        self.config.read_dict({
+            'general': {'check_logging': '0'},
+            'api': {'community_string': 'mytoken', 'backup_community_string': ''},
+            'metric history': {
+                'interval': '30',
+                'retention': '1h',
+                'minute_retention': '2h',
+                'hour_retention': '0',
+                'accessors': 'memory/virtual/percent, cpu/count?aggregate=sum, /memory/',
+            },
+        })
+        self.recorder = history.Recorder(self.config, self.testing_dir)
+
+    def tearDown(self):
+        for ring in history.series.values():
+            ring.close()
+        history.series.clear()
+        shutil.rmtree(self.testing_dir)
+
+    def test_parse_duration(self):
+        self.assertEqual(history.parse_duration('90'), 90)
+        self.assertEqual(history.parse_duration('15m'), 900)
+        self.assertEqual(history.parse_duration('2d'), 172800)
+        self.assertRaises(ValueError, history.parse_duration, '1 hour')
+
+    def test_sample(self):
+        now = int(time.time())
+        self.recorder.sample(now - 30)
+        self.recorder.sample(now)
+
+        metric = history.series['memory/virtual/percent']
+        self.assertEqual([x.capacity for x in metric.rings], [120, 120])
+        self.assertEqual(metric.unit, '%')
+        self.assertEqual(len(metric.rings[0].records()), 2)
+        self.assertEqual(history.series['cpu/count'].rings[0].records()[-1][1], os.cpu_count())
+
+        # Parent nodes can't be recorded
+        self.assertEqual(history.series['memory'].rings[0].records(), [])
+
+    def test_api_history(self):
+        listener.server.listener.config['iconfig'] = self.config
+        self.recorder.sample(int(time.time()))
+        client = listener.server.listener.test_client()
+        data = client.get('/api/memory/virtual/percent?history=1h&token=mytoken').get_json()
+        missing = client.get('/api/memory/virtual/used?history=1h&token=mytoken').get_json()
+
+        self.assertEqual(data['history']['unit'], '%')
+        self.assertEqual(data['history']['resolution'], 30)
+        self.assertEqual(len(data['history']['values']), 1)
+        self.assertIn('error', missing)
+
+
+if __name__ == '__main__':
+    unittest.main()
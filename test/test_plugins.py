@@ -0,0 +1,380 @@
+import includes_for_tests
+import io
+import os
+import sys
+import shutil
+import tempfile
+import time
+import unittest
+import gevent
+from configparser import ConfigParser
+from unittest import mock
+from werkzeug.datastructures import MultiDict
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.pluginnodes as pluginnodes
+import listener.pluginexecutor as pluginexecutor
+import listener.pluginworkers as pluginworkers
+
+
+class TestPluginIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.testing_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.testing_dir)
+        os.mkdir(os.path.join(self.testing_dir, 'sub'))
+        self.add_plugin('check_one.sh')
+        self.add_plugin('sub/check_two.sh')
+        self.add_plugin('.keep')
+
+        self.config = ConfigParser()
+        self.config.read_dict({'plugin directives': {'plugin_path': self.testing_dir, 'follow_symlinks': '0'}})
+        pluginnodes.index = pluginnodes.PluginIndex()
+        self.node = pluginnodes.PluginAgentNode('plugins')
+
+    def add_plugin(self, name, mtime=1000000000):
+        path = os.path.join(self.testing_dir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\necho "OK: $@"\n')
+        os.chmod(path, 0o755)
+
+        # Old directory times so the index is trusted right away
+        for directory in (os.path.dirname(path), self.testing_dir):
+            os.utime(directory, (mtime, mtime))
+
+    def test_walk(self):
+        self.assertEqual(self.node.walk(config=self.config), {'plugins': ['check_one.sh', 'check_two.sh']})
+
+    def test_cached(self):
+        self.node.walk(config=self.config)
+        with mock.patch('os.walk') as walk:
+            self.node.walk(config=self.config)
+            self.node.accessor(['check_two.sh'], self.config, '/api/plugins/check_two.sh', MultiDict())
+            walk.assert_not_called()
+
+    def test_changes(self):
+        self.node.walk(config=self.config)
+
+        self.add_plugin('sub/check_three.sh', 1000000100)
+        self.assertIn('check_three.sh', self.node.walk(config=self.config)['plugins'])
+
+        os.remove(os.path.join(self.testing_dir, 'check_one.sh'))
+        os.utime(self.testing_dir, (1000000200, 1000000200))
+        self.assertNotIn('check_one.sh', self.node.walk(config=self.config)['plugins'])
+
+    def test_recent_changes_not_trusted(self):
+        self.add_plugin('check_new.sh', int(pluginnodes.time.time()))
+        self.node.walk(config=self.config)
+        self.assertFalse(pluginnodes.index.is_current(self.testing_dir, False))
+
+    def test_missing_directory(self):
+        missing = os.path.join(self.testing_dir, 'missing')
+        self.config.set('plugin directives', 'plugin_path', missing)
+        self.assertEqual(self.node.walk(config=self.config), {'plugins': []})
+
+        os.mkdir(missing)
+        shutil.copy(os.path.join(self.testing_dir, 'check_one.sh'), missing)
+        self.assertEqual(self.node.walk(config=self.config), {'plugins': ['check_one.sh']})
+
+    def test_accessor(self):
+        args = MultiDict([('args', '-w 1')])
+        plugin = self.node.accessor(['check_two.sh'], self.config, '/api/plugins/check_two.sh', args)
+        self.assertEqual(plugin.plugin_abs_path, os.path.join(self.testing_dir, 'sub', 'check_two.sh'))
+        self.assertEqual(list(self.node.children), ['check_two.sh'])
+
+        # Arguments don't carry over to the next request
+        plugin = self.node.accessor(['check_two.sh'], self.config, '/api/plugins/check_two.sh', MultiDict())
+        self.assertEqual(plugin.arguments, [])
+
+        missing = self.node.accessor(['check_none.sh'], self.config, '/api/plugins/check_none.sh', MultiDict())
+        self.assertIsInstance(missing, listener.nodes.DoesNotExistNode)
+
+
+class TestPluginExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, listener.server, '__INTERNAL__', listener.server.__INTERNAL__)
+        listener.server.__INTERNAL__ = True
+        self.executor = pluginexecutor.PluginExecutor()
+        self.addCleanup(setattr, pluginexecutor, 'executor', pluginexecutor.executor)
+        pluginexecutor.executor = self.executor
+        self.concurrency = 20
+        self.options = {}
+        patcher = mock.patch.object(self.executor, 'get_concurrency', side_effect=lambda: self.concurrency)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        get_config_value = listener.server.get_config_value
+        patcher = mock.patch.object(listener.server, 'get_config_value',
+                                    side_effect=lambda s, o, d=None: self.options.get(o, d) if s == 'plugin directives' else get_config_value(s, o, d))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.testing_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.testing_dir)
+        self.config = ConfigParser()
+        self.config.read_dict({'plugin directives': {'plugin_path': self.testing_dir, 'plugin_timeout': '1',
+                                                     '.py': '%s $plugin_name $plugin_args' % sys.executable}})
+        count = os.path.join(self.testing_dir, 'count')
+        plugins = (('check_echo.sh', 'echo "OK: $@"'), ('check_hang.sh', 'sleep 10'),
+                   ('check_count.sh', 'sleep 0.2; echo run >> %s; echo "OK: $(wc -l < %s) $@"' % (count, count)))
+        for name, script in plugins:
+            with open(os.path.join(self.testing_dir, name), 'w') as f:
+                f.write('#!/bin/sh\n%s\n' % script)
+            os.chmod(os.path.join(self.testing_dir, name), 0o755)
+        self.node = pluginnodes.PluginAgentNode('plugins')
+
+    def run_plugin(self, name, args=(), **kwargs):
+        plugin = self.node.accessor([name], self.config, '/api/plugins/' + name, MultiDict([('args', x) for x in args]))
+        kwargs.setdefault('debug', False)
+        return plugin.walk(self.config, accessor='plugins/' + name, remote_addr='127.0.0.1', **kwargs)
+
+    @unittest.skipIf(os.name != 'posix', 'uses shell plugins')
+    def test_execute_plugin(self):
+        self.assertEqual(self.run_plugin('check_echo.sh', ['-w 1']), {'returncode': 0, 'stdout': 'OK: -w 1'})
+
+    @unittest.skipIf(os.name != 'posix', 'uses shell plugins')
+    def test_timeout(self):
+        start = time.time()
+        result = self.run_plugin('check_hang.sh')
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(result['returncode'], -1)
+        self.assertIn('timed out', result['stdout'])
+
+    @unittest.skipIf(os.name != 'posix', 'uses sleep')
+    def test_concurrency(self):
+        self.concurrency = 2
+        start = time.time()
+        runs = [gevent.spawn(self.executor.run, ['sleep', '0.3'], 5) for _ in range(4)]
+        gevent.joinall(runs)
+        self.assertGreaterEqual(time.time() - start, 0.6)
+        self.assertTrue(all(x.value.returncode == 0 for x in runs))
+
+    @unittest.skipIf(os.name != 'posix', 'uses sleep')
+    def test_queue_full_collapsed(self):
+        # Requests waiting on an identical run count against the queue size
+        self.options['plugin_queue_size'] = '1'
+        runs = [gevent.spawn(self.executor.run_cached, ['sleep', '0.3'], 5, 'check_db.sh') for _ in range(3)]
+        gevent.joinall(runs)
+
+        results = [x.value[0] for x in runs]
+        self.assertEqual([x.returncode for x in results], [0, 0, 3])
+        self.assertIs(results[0], results[1])
+        self.assertEqual(self.executor.get_queue_stats()['plugins']['check_db.sh']['rejected'], 1)
+        self.assertEqual(self.executor.total.waiting, 0)
+
+    def run_many(self, count, name='check_db.sh', sleep='0.3'):
+        runs = [gevent.spawn(self.executor.run, ['sleep', sleep], 5, name) for _ in range(count)]
+        gevent.joinall(runs)
+        return [x.value for x in runs]
+
+    @unittest.skipIf(os.name != 'posix', 'uses sleep')
+    def test_plugin_limit(self):
+        self.options['plugin_concurrency_limits'] = 'check_db.sh:1, bogus'
+        start = time.time()
+        results = self.run_many(3)
+        self.assertGreaterEqual(time.time() - start, 0.9)
+        self.assertTrue(all(x.returncode == 0 for x in results))
+
+        stats = self.executor.get_queue_stats()
+        self.assertEqual(stats['limits'], {'check_db.sh': 1})
+        self.assertEqual(stats['plugins']['check_db.sh']['runs'], 3)
+        self.assertGreater(stats['plugins']['check_db.sh']['max_wait'], 0.5)
+
+    @unittest.skipIf(os.name != 'posix', 'uses sleep')
+    def test_queue_full(self):
+        self.concurrency = 1
+        self.options['plugin_queue_size'] = '1'
+        results = self.run_many(3)
+
+        self.assertEqual(sorted(x.returncode for x in results), [0, 0, 3])
+        self.assertIn('queue is full', [x for x in results if x.returncode == 3][0].stdout)
+        self.assertEqual(self.executor.get_queue_stats()['total']['rejected'], 1)
+
+    @unittest.skipIf(os.name != 'posix', 'uses sleep')
+    def test_queue_timeout(self):
+        self.concurrency = 1
+        self.options['plugin_queue_timeout'] = '0.1'
+        results = self.run_many(2)
+
+        self.assertEqual(sorted(x.returncode for x in results), [0, 3])
+        self.assertEqual(self.executor.get_queue_stats()['plugins']['check_db.sh']['timed_out'], 1)
+
+    def test_api_queue(self):
+        self.addCleanup(listener.server.listener.config.__setitem__, 'iconfig', listener.server.listener.config.get('iconfig'))
+        config = ConfigParser()
+        config.read_dict({'api': {'community_string': 'mytoken', 'backup_community_string': ''}})
+        listener.server.listener.config['iconfig'] = config
+
+        data = listener.server.listener.test_client().get('/api/agent/plugins/queue?token=mytoken').get_json()
+        self.assertEqual(data['queue']['total']['waiting'], 0)
+
+    @unittest.skipIf(os.name != 'posix', 'uses shell plugins')
+    def test_cache(self):
+        self.options['plugin_cache_ttl'] = 'check_count.sh:60'
+        self.assertEqual(self.run_plugin('check_count.sh')['stdout'], 'OK: 1')
+        result = self.run_plugin('check_count.sh', debug=True)
+        self.assertEqual(result['stdout'], 'OK: 1')
+        self.assertIn('cache_age', result)
+
+        # Results are cached for each set of arguments and can be skipped
+        self.assertEqual(self.run_plugin('check_count.sh', ['-w 1'])['stdout'], 'OK: 2 -w 1')
+        self.assertEqual(self.run_plugin('check_count.sh', cache_ttl=['0'])['stdout'], 'OK: 3')
+        self.assertEqual(self.run_plugin('check_echo.sh', cache_ttl=['60'], debug=True).get('cache_age'), None)
+        self.assertIn('cache_age', self.run_plugin('check_echo.sh', cache_ttl=['60'], debug=True))
+
+    @unittest.skipIf(os.name != 'posix', 'uses shell plugins')
+    def test_collapse_identical_runs(self):
+        runs = [gevent.spawn(self.run_plugin, 'check_count.sh') for _ in range(5)]
+        gevent.joinall(runs)
+
+        self.assertEqual(set(x.value['stdout'] for x in runs), set(['OK: 1']))
+        self.assertEqual(self.run_plugin('check_count.sh')['stdout'], 'OK: 2')
+        self.assertEqual(self.executor.cache, {})
+
+    @unittest.skipIf(os.name != 'posix', 'uses shell plugins')
+    def test_run_stats(self):
+        self.add_shell_plugin('check_exit.sh', 'echo "$1"; exit $1')
+        self.options['plugin_cache_ttl'] = 'check_exit.sh:60'
+        for code in ('0', '0', '2', '2', '2'):
+            self.run_plugin('check_exit.sh', [code])
+        self.run_plugin('check_hang.sh')
+
+        stats = self.executor.get_plugin_stats()
+        self.assertEqual(list(stats['plugins']), ['check_hang.sh', 'check_exit.sh'])
+        plugin = stats['plugins']['check_exit.sh']
+        self.assertEqual((plugin['calls'], plugin['cached']), (2, 3))
+        self.assertEqual(plugin['exit_codes'], {'0': 1, '2': 1})
+        self.assertEqual(plugin['output_bytes'], 4)
+        self.assertEqual(sum(plugin['latency']['histogram'].values()), 2)
+        self.assertEqual(stats['plugins']['check_hang.sh']['timeouts'], 1)
+        self.assertGreaterEqual(stats['plugins']['check_hang.sh']['latency']['p99'], 1)
+        self.assertEqual(stats['total']['calls'], 3)
+
+    def test_percentiles(self):
+        stats = pluginexecutor.PluginRunStats()
+        for run_time in range(1, 101):
+            stats.add_run(pluginexecutor.PluginResult('', 0, False, 0, run_time / 100.0))
+        latency = stats.as_dict()['latency']
+        self.assertEqual((latency['p50'], latency['p95'], latency['p99'], latency['max']), (0.5, 0.95, 0.99, 1))
+        self.assertEqual(latency['histogram']['le_1'], 50)
+        self.assertEqual(pluginexecutor.PluginRunStats().as_dict()['latency']['p50'], 0)
+
+    def test_api_stats(self):
+        self.addCleanup(listener.server.listener.config.__setitem__, 'iconfig', listener.server.listener.config.get('iconfig'))
+        config = ConfigParser()
+        config.read_dict({'api': {'community_string': 'mytoken', 'backup_community_string': ''}})
+        listener.server.listener.config['iconfig'] = config
+
+        self.executor.run(['true'], 5, 'true')
+        data = listener.server.listener.test_client().get('/api/agent/plugins/stats?token=mytoken').get_json()
+        self.assertEqual(data['stats']['plugins']['true']['exit_codes'], {'0': 1})
+
+    def add_shell_plugin(self, name, script):
+        with open(os.path.join(self.testing_dir, name), 'w') as f:
+            f.write('#!/bin/sh\n%s\n' % script)
+        os.chmod(os.path.join(self.testing_dir, name), 0o755)
+
+    @unittest.skipIf(os.name != 'posix', 'uses shell plugins')
+    def test_output_limit(self):
+        self.add_shell_plugin('check_loud.sh', 'printf "WARNING: loud\\r\\nline\\r"; head -c 5000000 /dev/zero | tr "\\0" x; exit 1')
+
+        result = self.run_plugin('check_loud.sh')
+        self.assertEqual(result['returncode'], 1)
+        self.assertTrue(result['stdout'].startswith('WARNING: loud\nline\nxxx'))
+        self.assertTrue(result['stdout'].endswith('\n... output truncated at 1048576 bytes'))
+        self.assertEqual(len(result['stdout'].splitlines()[2]), 1048576 - len('WARNING: loud\r\nline\r'))
+
+        self.options['plugin_output_max'] = '0'
+        self.assertEqual(len(self.run_plugin('check_loud.sh')['stdout']), 5000000 + len('WARNING: loud\nline\n'))
+
+    @unittest.skipIf(os.name != 'posix', 'uses shell plugins')
+    def test_stderr(self):
+        self.add_shell_plugin('check_stderr.sh', 'echo "OK: out"; echo "error" >&2')
+
+        self.assertEqual(self.run_plugin('check_stderr.sh')['stdout'], 'OK: out\nerror')
+        self.options['plugin_stderr'] = 'separate'
+        result = self.run_plugin('check_stderr.sh', debug=True)
+        self.assertEqual((result['stdout'], result['stderr']), ('OK: out', 'error'))
+        self.options['plugin_stderr'] = 'discard'
+        self.assertEqual(self.run_plugin('check_stderr.sh', debug=True)['stdout'], 'OK: out')
+        self.assertNotIn('stderr', self.run_plugin('check_stderr.sh', debug=True))
+
+    @unittest.skipIf(os.name != 'posix', 'uses shell plugins')
+    def test_output_held_open(self):
+        # A plugin that exits but leaves something running with its output open
+        # times out like it did with communicate()
+        self.add_shell_plugin('check_background.sh', 'sleep 10 &\necho "OK"')
+        start = time.time()
+        result = self.run_plugin('check_background.sh')
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(result['returncode'], -1)
+
+    def add_python_plugin(self, name, code, worker=True):
+        with open(os.path.join(self.testing_dir, name), 'w') as f:
+            f.write(('# ncpa: worker\n' if worker else '') + code)
+
+    def test_python_workers(self):
+        self.options['python_workers'] = '1'
+        self.addCleanup(pluginworkers.pools.clear)
+        self.addCleanup(lambda: [x.close() for x in pluginworkers.pools.values()])
+        with open(os.path.join(self.testing_dir, 'helper.py'), 'w') as f:
+            f.write('count = 0\n')
+        code = 'import sys, helper\nhelper.count += 1\nprint("OK: %d %s" % (helper.count, " ".join(sys.argv[1:])))\nsys.exit(1 if "-w" in sys.argv else 0)\n'
+        self.add_python_plugin('check_worker.py', code)
+        self.add_python_plugin('check_plain.py', code, worker=False)
+        self.add_python_plugin('check_hang.py', 'import time\ntime.sleep(10)\n')
+        self.add_python_plugin('check_crash.py', 'import os\nos._exit(5)\n')
+
+        # Imports are kept between runs in the worker
+        self.assertEqual(self.run_plugin('check_worker.py'), {'returncode': 0, 'stdout': 'OK: 1'})
+        self.assertEqual(self.run_plugin('check_worker.py', ['-w 5']), {'returncode': 1, 'stdout': 'OK: 2 -w 5'})
+        self.assertEqual(self.run_plugin('check_plain.py')['stdout'], 'OK: 1')
+        self.assertEqual(self.run_plugin('check_plain.py')['stdout'], 'OK: 1')
+
+        # Workers that time out or crash are replaced
+        result = self.run_plugin('check_hang.py')
+        self.assertEqual(result['returncode'], -1)
+        self.assertIn('timed out', result['stdout'])
+        self.assertEqual(self.run_plugin('check_crash.py')['returncode'], 3)
+        self.assertEqual(self.run_plugin('check_worker.py'), {'returncode': 0, 'stdout': 'OK: 1'})
+
+    def test_python_workers_bad_reply(self):
+        self.add_python_plugin('check_worker.py', 'print("OK")\n')
+        argv = [os.path.join(self.testing_dir, 'check_worker.py')]
+        pool = pluginworkers.PythonWorkerPool((sys.executable,), 1)
+        self.addCleanup(pool.close)
+
+        # A garbled reply kills the worker instead of leaking it
+        worker = pool.idle[0]
+        worker.process.stdout = io.BytesIO(b'{"stdout": "OK\n')
+        stdout, stderr, returncode, killed, truncated = pool.run(argv, 5)
+        self.assertEqual(returncode, 3)
+        self.assertIn('invalid reply', stdout)
+        self.assertIsNotNone(worker.process.poll())
+        self.assertEqual(pool.idle, [])
+        self.assertEqual(pool.run(argv, 5), ('OK\n', None, 0, False, False))
+
+    def test_python_workers_output(self):
+        self.options.update(python_workers='1', plugin_output_max='100', plugin_stderr='separate')
+        self.addCleanup(pluginworkers.pools.clear)
+        self.addCleanup(lambda: [x.close() for x in pluginworkers.pools.values()])
+        self.add_python_plugin('check_loud.py', 'import sys\nprint("OK: loud\\r\\n" + "x" * 1000)\nsys.stderr.write("error")\n')
+
+        result = self.run_plugin('check_loud.py', debug=True)
+        self.assertEqual(result['stdout'], 'OK: loud\n' + 'x' * 90 + '\n... output truncated at 100 bytes')
+        self.assertEqual(result['stderr'], 'error')
+
+    def test_python_workers_disabled(self):
+        self.add_python_plugin('check_worker.py', 'print("OK")\n')
+        cmd = [sys.executable, os.path.join(self.testing_dir, 'check_worker.py')]
+        self.assertIsNone(pluginworkers.get_worker_command(cmd, cmd[1]))
+
+        self.options['python_workers'] = '2'
+        self.assertEqual(pluginworkers.get_worker_command(cmd, cmd[1]), ((sys.executable,), [cmd[1]]))
+        self.assertIsNone(pluginworkers.get_worker_command(['sudo'] + cmd, cmd[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
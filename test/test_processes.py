@@ -0,0 +1,237 @@
+import includes_for_tests
+import getpass
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+from unittest import mock
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.processes as processes
+
+
+class TestProcessNode(unittest.TestCase):
+
+    def setUp(self):
+        processes.sampler.snapshot = None
+        processes.index = processes.ProcessIndex()
+        self.node = processes.get_node()
+
+    def get_own_process(self, procs):
+        return [x for x in procs if x['pid'] == os.getpid()][0]
+
+    def test_get_process_dict(self):
+        proc = self.get_own_process(self.node.get_process_dict())
+
+        self.assertEqual(sorted(proc), sorted(processes.ProcessNode.process_fields))
+        self.assertEqual(proc['username'], getpass.getuser())
+        self.assertGreater(proc['mem_rss'][0], 0)
+        self.assertGreater(proc['mem_percent'][0], 0)
+
+    def test_get_process_dict_fields(self):
+        proc = self.get_own_process(self.node.get_process_dict(output_fields=['pid', 'name']))
+        self.assertEqual(sorted(proc), ['name', 'pid'])
+
+        # Fields used by filters are always read
+        procs = self.node.get_process_dict(output_fields=['pid'], mem_rss=['1'])
+        self.assertIn('mem_rss', self.get_own_process(procs))
+
+    def test_get_process_dict_sleep(self):
+        # The sleep is done once for all processes, not once per process
+        start = time.time()
+        procs = self.node.get_process_dict(sleep=['0.2'], output_fields=['pid', 'cpu_percent'])
+        self.assertLess(time.time() - start, 0.2 * len(procs))
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_get_process_dict_snapshot(self):
+        self.node.get_process_dict()
+        snapshot = processes.sampler.get_snapshot()
+        self.assertIsNotNone(snapshot)
+
+        # Requests share the snapshot unless they ask for fresh data, partial
+        # scans are never shared
+        self.node.get_process_dict(name=['python'])
+        self.assertIs(processes.sampler.snapshot, snapshot)
+        self.node.get_process_dict(fresh=['1'], output_fields=['pid'])
+        self.assertIs(processes.sampler.snapshot, snapshot)
+        self.node.get_process_dict(fresh=['1'])
+        self.assertIsNot(processes.sampler.snapshot, snapshot)
+
+    def test_sampler_subscribe(self):
+        processes.sampler.subscribe()
+        processes.sampler.subscribe()
+        try:
+            snapshot = processes.sampler.wait(5)
+            self.assertIsNotNone(snapshot)
+            self.assertTrue(snapshot.is_complete())
+        finally:
+            processes.sampler.unsubscribe()
+            processes.sampler.unsubscribe()
+        processes.sampler.greenlet.join(5)
+        self.assertTrue(processes.sampler.greenlet.dead)
+
+    def test_snapshot_time(self):
+        # Snapshots are stamped when the scan is done
+        with mock.patch.object(processes.psutil, 'process_iter', side_effect=lambda **kw: time.sleep(0.2) or []):
+            start = time.time()
+            snapshot = processes.ProcessSnapshot()
+        self.assertGreaterEqual(snapshot.time, start + 0.2)
+
+    def test_top_message(self):
+        snapshot = processes.ProcessSnapshot()
+        processes.sampler.snapshot = None
+
+        # The message is built from the snapshot given without scanning again
+        with mock.patch.object(processes, 'ProcessSnapshot', side_effect=AssertionError):
+            message = json.loads(listener.server.get_top_message(snapshot))
+        pids = [x['pid'] for x in snapshot.infos if x['pid'] != 0]
+        self.assertEqual([x['pid'] for x in message['process']], pids)
+        self.assertEqual(sorted(message['process'][0]), ['cpu_percent', 'mem_percent', 'name', 'pid', 'username'])
+        self.assertIs(listener.server.get_top_message(snapshot), listener.server.top_message[1])
+
+    def test_make_filter(self):
+        proc = {'name': 'Python3', 'username': 'nagios', 'exe': '/usr/bin/python3', 'cmd': '',
+                'cpu_percent': (2.5, '%'), 'mem_percent': (1.0, '%'), 'mem_rss': (100, 'B'), 'mem_vms': (200, 'B')}
+
+        self.assertTrue(self.node.make_filter(name=['python3'])(proc))
+        self.assertFalse(self.node.make_filter(name=['python'])(proc))
+        self.assertTrue(self.node.make_filter(name=['PYTH'], match=['search'])(proc))
+        self.assertTrue(self.node.make_filter(exe=[r'python\d$'], match=['regex'])(proc))
+        self.assertFalse(self.node.make_filter(name=['python3'], cpu_percent=['5'])(proc))
+        self.assertTrue(self.node.make_filter(name=['python3'], cpu_percent=['5'], combiner=['or'])(proc))
+
+        # Empty command lines never match and bad regexes match nothing
+        self.assertFalse(self.node.make_filter(cmd=[''], match=['search'])(proc))
+        self.assertFalse(self.node.make_filter(name=['('], match=['regex'])(proc))
+
+    def test_get_process_dict_prefilter(self):
+        name = self.get_own_process(self.node.get_process_dict())['name']
+        procs = self.node.get_process_dict(fresh=['1'], name=[name])
+
+        # Prefiltered scans only read the rest of the attributes for matches
+        self.assertIn(os.getpid(), [x['pid'] for x in procs])
+        self.assertTrue(all(x['name'] == name for x in procs))
+        self.assertIn('cmd', procs[0])
+
+    def test_sort_processes(self):
+        procs = [{'pid': i, 'name': 'proc%d' % (i % 3), 'cpu_percent': (i % 7, '%')} for i in range(20)]
+
+        top = self.node.sort_processes(procs, {'sort': ['cpu_percent'], 'limit': ['3']})
+        self.assertEqual([x['cpu_percent'][0] for x in top], [6, 6, 5])
+
+        page = self.node.sort_processes(procs, {'sort': ['pid'], 'order': ['desc'], 'limit': ['2'], 'offset': ['3']})
+        self.assertEqual([x['pid'] for x in page], [16, 15])
+
+        names = self.node.sort_processes(procs, {'sort': ['name']})
+        self.assertEqual(names[0]['name'], 'proc0')
+        self.assertEqual(len(names), 20)
+
+        self.assertEqual(len(self.node.sort_processes(procs, {'offset': ['15'], 'sort': ['bogus']})), 5)
+
+    def test_walk_fields(self):
+        procs = self.node.walk(fields=['pid,name'], sort=['mem_rss'], limit=['5'])['processes']
+
+        self.assertEqual(len(procs), 5)
+        self.assertEqual(sorted(procs[0]), ['name', 'pid'])
+
+    def test_walk_group_by(self):
+        own = self.get_own_process(self.node.get_process_dict())
+        groups = self.node.walk(group_by=['username'], fresh=['1'])['processes']
+        procs = [x for x in self.node.get_process_dict() if x['username'] == own['username']]
+        group = groups[own['username']]
+
+        self.assertEqual(group['count'], len(procs))
+        self.assertGreaterEqual(group['mem_rss']['max'][0], own['mem_rss'][0])
+        self.assertEqual(group['mem_rss']['avg'][0], round(group['mem_rss']['sum'][0] / group['count'], 2))
+
+    def test_run_check_group_by(self):
+        self.addCleanup(setattr, listener.server, '__INTERNAL__', listener.server.__INTERNAL__)
+        listener.server.__INTERNAL__ = True
+        name = self.get_own_process(self.node.get_process_dict())['name']
+        kwargs = {'group_by': ['name'], 'name': [name], 'group_stat': ['count'], 'config': None,
+                  'accessor': 'processes', 'remote_addr': '127.0.0.1'}
+
+        result = self.node.run_check(critical=['0'], **kwargs)
+        self.assertEqual(result['returncode'], 2)
+        self.assertIn("'%s'=" % name, result['stdout'])
+
+        result = self.node.run_check(group_metric=['mem_rss'], **dict(kwargs, group_stat=['max']))
+        self.assertEqual(result['returncode'], 0)
+        self.assertTrue(result['stdout'].startswith('OK: Max mem_rss of processes by name was %s' % name))
+
+    def test_process_index(self):
+        child = subprocess.Popen(['sleep', '60'])
+        self.addCleanup(child.wait)
+        self.addCleanup(child.kill)
+
+        procs = self.node.get_process_dict(name=['SLEEP'])
+        self.assertIn(child.pid, [x['pid'] for x in procs])
+        self.assertIn(child.pid, processes.index.find({'name': ['sleep']}))
+        self.assertEqual(processes.index.find({'name': ['sleep'], 'exe': ['/bogus']}), set())
+
+        # New processes are only found by the next full scan
+        other = subprocess.Popen(['sleep', '60'])
+        self.addCleanup(other.wait)
+        self.addCleanup(other.kill)
+        procs = self.node.get_process_dict(name=['sleep'])
+        self.assertNotIn(other.pid, [x['pid'] for x in procs])
+
+        # Unless an indexed process is gone, which rescans right away
+        child.kill()
+        child.wait()
+        procs = self.node.get_process_dict(name=['sleep'])
+        self.assertNotIn(child.pid, [x['pid'] for x in procs])
+        self.assertIn(other.pid, [x['pid'] for x in procs])
+
+    def test_process_index_not_used(self):
+        self.node.get_process_dict(name=['sleep'], match=['search'])
+        self.node.get_process_dict(name=['sleep'], combiner=['or'])
+        self.node.get_process_dict(username=[getpass.getuser()])
+        self.assertEqual(processes.index.time, 0)
+
+    def test_make_process_lines(self):
+        procs = [{'pid': i, 'name': 'proc', 'username': 'nagios', 'cpu_percent': (i % 7, '%'), 'mem_percent': (1.0, '%'),
+                  'mem_rss': (i * 10, 'B'), 'mem_vms': (100, 'B')} for i in range(50)]
+        limits = {'process_output_lines': 5, 'process_output_bytes': 0}
+
+        with mock.patch.object(listener.server, 'get_config_value', side_effect=lambda s, o, d: limits[o]):
+            lines = self.node.make_process_lines(procs, {'sort': ['mem_rss']}).splitlines()
+            self.assertEqual(len(lines), 6)
+            self.assertTrue(lines[0].startswith('49: proc: nagios: 1.0 % (VMS 100.00 B, RSS 490.00 B)'))
+            self.assertEqual(lines[-1], '... and 45 more processes')
+
+            limits.update(process_output_lines=0, process_output_bytes=200)
+            output = self.node.make_process_lines(procs, {})
+            self.assertLessEqual(len(output.rsplit('...', 1)[0]), 200)
+            self.assertTrue(output.startswith('0: proc'))
+
+            limits.update(process_output_bytes=0)
+            self.assertEqual(len(self.node.make_process_lines(procs, {}).splitlines()), 50)
+
+            # The limit is in bytes, not characters
+            limits.update(process_output_bytes=200)
+            wide = [dict(x, name='\u30d7' * 20) for x in procs]
+            output = self.node.make_process_lines(wide, {})
+            self.assertLessEqual(len(output.rsplit('...', 1)[0].encode('utf-8')), 200)
+
+    def test_run_check_output_limit(self):
+        self.addCleanup(setattr, listener.server, '__INTERNAL__', listener.server.__INTERNAL__)
+        listener.server.__INTERNAL__ = True
+        procs = self.node.get_process_dict()
+        limits = {'process_output_lines': 2, 'process_output_bytes': 0, 'process_index_interval': 60,
+                  'process_sample_interval': 1}
+
+        with mock.patch.object(listener.server, 'get_config_value', side_effect=lambda s, o, d: limits[o]):
+            result = self.node.run_check(config=None, accessor='processes', remote_addr='127.0.0.1')
+
+        # Totals still cover every process
+        self.assertIn("'process_count'=%d;" % len(procs), result['stdout'])
+        self.assertIn('... and %d more processes' % (len(procs) - 2), result['stdout'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+import includes_for_tests
+import os
+import sys
+import time
+import unittest
+import gevent
+from configparser import ConfigParser
+from unittest import mock
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.services as services
+
+
+class TestServiceNode(unittest.TestCase):
+
+    def setUp(self):
+        services.init_system = None
+        self.addCleanup(setattr, services, 'init_system', None)
+        self.node = services.get_node()
+        self.config = ConfigParser()
+        self.config.read_dict({'listener': {'init_system': 'auto'}})
+
+    def test_detect_init_system_once(self):
+        with mock.patch('subprocess.Popen') as popen:
+            method = self.node.get_service_method()
+            self.assertEqual(method, self.node.get_service_method())
+            popen.assert_not_called()
+
+        with mock.patch.object(services, 'detect_init_system') as detect:
+            self.node.get_service_method()
+            detect.assert_not_called()
+
+    @unittest.skipIf(os.name != 'posix', 'uses Linux init systems')
+    def test_detect_init_system(self):
+        with mock.patch('platform.uname', return_value=('Linux',)):
+            with mock.patch('shutil.which', side_effect=lambda x: '/sbin/initctl' if x == 'initctl' else None):
+                self.assertEqual(services.detect_init_system(self.config), 'initctl')
+            with mock.patch('shutil.which', return_value=None):
+                self.assertEqual(services.detect_init_system(self.config), 'initd')
+
+    def test_detect_init_system_config(self):
+        self.config.set('listener', 'init_system', 'SysV')
+        self.assertEqual(services.detect_init_system(self.config), 'initd')
+        self.assertEqual(self.node.get_service_method(), self.node.get_services_via_initd)
+
+        # Unknown values are ignored
+        self.config.set('listener', 'init_system', 'bogus')
+        self.assertIn(services.detect_init_system(self.config), services.init_systems.values())
+
+
+class TestSystemctl(unittest.TestCase):
+
+    show_output = (b'LoadState=loaded\nActiveState=active\nSubState=running\n\n'
+                   b'LoadState=loaded\nActiveState=inactive\nSubState=dead\n\n'
+                   b'LoadState=not-found\nActiveState=inactive\nSubState=dead\n')
+    list_output = (b'sshd.service   loaded active running OpenSSH server daemon\n'
+                   b'nginx.service  loaded failed failed  nginx web server\n')
+
+    def setUp(self):
+        self.addCleanup(setattr, listener.server, '__INTERNAL__', listener.server.__INTERNAL__)
+        listener.server.__INTERNAL__ = True
+        self.addCleanup(setattr, services, 'init_system', None)
+        services.init_system = 'systemctl'
+        self.node = services.get_node()
+
+    # Fake systemctl, the unit list is written to a temporary file
+    def popen(self, stdout):
+        def run(command, **kwargs):
+            if hasattr(kwargs.get('stdout'), 'write'):
+                kwargs['stdout'].write(stdout)
+            process = mock.Mock(returncode=0)
+            process.communicate.return_value = (stdout, b'')
+            return process
+        return mock.patch('subprocess.Popen', side_effect=run)
+
+    def test_exact_services(self):
+        with self.popen(self.show_output) as popen:
+            result = self.node.walk(service=['sshd', 'nginx', 'missing'])['services']
+        command = popen.call_args[0][0]
+
+        self.assertIn('show', command)
+        self.assertEqual(command[-3:], ['sshd.service', 'nginx.service', 'missing.service'])
+        self.assertEqual(result, {'sshd': 'running', 'nginx': 'stopped'})
+
+    def test_exact_services_check(self):
+        kwargs = {'service': ['sshd', 'nginx', 'missing'], 'config': None, 'accessor': 'services', 'remote_addr': '127.0.0.1'}
+        with self.popen(self.show_output):
+            result = self.node.run_check(**kwargs)
+
+        self.assertEqual(result['returncode'], 3)
+        self.assertIn('nginx is stopped (should be running)', result['stdout'])
+        self.assertIn('missing could not be found', result['stdout'])
+
+    def test_search_lists_all_units(self):
+        with self.popen(self.list_output) as popen:
+            result = self.node.walk(service=['SSH'], match=['search'])['services']
+
+        self.assertIn('list-units', popen.call_args[0][0])
+        self.assertEqual(result, {'sshd': 'running'})
+
+    def test_status_lists_all_units(self):
+        with self.popen(self.list_output) as popen:
+            result = self.node.walk(status=['stopped'])['services']
+
+        self.assertIn('list-units', popen.call_args[0][0])
+        self.assertEqual(result, {'nginx': 'stopped'})
+
+
+class TestInitd(unittest.TestCase):
+
+    def setUp(self):
+        services.initd_statuses.clear()
+        self.node = services.get_node()
+        self.probed = []
+
+    # Fake 'service <name> status' which takes a while and honors the timeout
+    def get_status(self, service, timeout=2):
+        self.probed.append(service)
+        gevent.sleep(min(0.2, timeout))
+        if timeout < 0.2:
+            return 'unknown'
+        return 'stopped' if service.startswith('stopped') else 'running'
+
+    def test_probe_initd_services(self):
+        names = ['service%d' % i for i in range(8)] + ['stopped']
+        with mock.patch.object(self.node, 'get_initd_service_status', side_effect=self.get_status):
+            start = time.time()
+            statuses = self.node.probe_initd_services(names)
+            self.assertLess(time.time() - start, 0.2 * len(names) / 2)
+
+            # Cached results are used until they expire
+            self.node.probe_initd_services(names)
+            self.assertEqual(len(self.probed), len(names))
+
+        self.assertEqual(statuses['stopped'], 'stopped')
+        self.assertEqual(statuses['service0'], 'running')
+
+    def test_probe_initd_services_deadline(self):
+        self.node.initd_workers = 2
+        self.node.initd_deadline = 0.3
+        names = ['service%d' % i for i in range(10)]
+        with mock.patch.object(self.node, 'get_initd_service_status', side_effect=self.get_status):
+            start = time.time()
+            statuses = self.node.probe_initd_services(names)
+
+        # Scripts that couldn't be checked in time are unknown and not cached
+        self.assertLess(time.time() - start, 1)
+        self.assertIn('unknown', statuses.values())
+        self.assertEqual(len(statuses), 10)
+        self.assertTrue(all(x[1] != 'unknown' for x in services.initd_statuses.values()))
+
+
+class TestServiceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(listener.server.listener.config.__setitem__, 'iconfig', listener.server.listener.config.get('iconfig'))
+        self.config = ConfigParser()
+        self.config.read_dict({
+            'api': {'community_string': 'mytoken', 'backup_community_string': ''},
+            'listener': {'service_cache_interval': '30'},
+        })
+        listener.server.listener.config['iconfig'] = self.config
+        self.cache = services.ServiceCache()
+        self.addCleanup(setattr, services, 'cache', services.cache)
+        services.cache = self.cache
+        self.node = services.get_node()
+
+    def test_update_changes(self):
+        self.cache.update({'sshd': 'running', 'httpd': 'running', 'crond': 'running'}, 1000)
+        self.cache.update({'sshd': 'running', 'httpd': 'stopped', 'cups': 'running'}, 1030)
+
+        self.assertEqual(len(self.cache.get_changes(0)), 4)
+        self.assertEqual(self.cache.get_changes(1000), {
+            'httpd': {'status': 'stopped', 'changed': 1030},
+            'crond': {'status': 'removed', 'changed': 1030},
+            'cups': {'status': 'running', 'changed': 1030},
+        })
+
+    def test_prune_changes(self):
+        self.cache.changes_retention = 100
+        self.cache.update({'sshd': 'running', 'run-1.scope': 'running'}, 1000)
+        self.cache.update({'sshd': 'running', 'run-2.scope': 'running'}, 1050)
+        self.cache.update({'sshd': 'running'}, 1120)
+
+        # Changes older than the retention are dropped
+        self.assertEqual(sorted(self.cache.changes), ['run-1.scope', 'run-2.scope'])
+        self.assertEqual(self.cache.changes['run-2.scope'], (1120, 'removed'))
+        self.cache.update({'sshd': 'running'}, 1300)
+        self.assertEqual(self.cache.changes, {})
+
+    def test_service_method_uses_cache(self):
+        self.assertNotEqual(self.node.get_service_method(), self.node.get_services_via_cache)
+
+        self.cache.update({'sshd': 'running', 'httpd': 'stopped'})
+        with mock.patch('subprocess.Popen') as popen:
+            result = self.node.walk(service=['httpd'])['services']
+            popen.assert_not_called()
+        self.assertEqual(result, {'httpd': 'stopped'})
+
+        # Old caches aren't used if the refreshes stopped
+        self.cache.time -= 61
+        self.assertNotEqual(self.node.get_service_method(), self.node.get_services_via_cache)
+
+    def test_api_changes(self):
+        self.cache.update({'sshd': 'running'}, 1000)
+        self.cache.update({'sshd': 'stopped'}, 1030)
+        client = listener.server.listener.test_client()
+
+        data = client.get('/api/services/changes?since=1000&token=mytoken').get_json()
+        self.assertEqual(data, {'time': 1030, 'changes': {'sshd': {'status': 'stopped', 'changed': 1030}}})
+
+        self.config.set('listener', 'service_cache_interval', '0')
+        self.assertIn('error', client.get('/api/services/changes?token=mytoken').get_json())
+
+
+if __name__ == '__main__':
+    unittest.main()